@@ -0,0 +1,90 @@
+import asyncio
+import collections
+import math
+import metrics
+import profiling
+import time
+
+from aiohttp import web, web_exceptions
+from model import OverloadedException
+
+
+class AdmissionLimiter:
+    """
+    Ограничивает число одновременно обрабатываемых запросов.
+
+    Запросы сверх limit ждут в очереди длиной не больше queue_size не дольше timeout секунд. Если очередь заполнена
+    или время ожидания истекло, клиент сразу получает 503 с заголовком Retry-After. Тот же ответ получает запрос,
+    которому не хватило соединения с базой (OverloadedException).
+    """
+
+    def __init__(self, limit, queue_size, timeout):
+        self.__limit = limit
+        self.__queue_size = queue_size
+        self.__timeout = timeout
+        self.__active = 0
+        self.__waiters = collections.deque()
+
+    def middleware(self, exempt=()):
+        @web.middleware
+        async def admission(request, handler):
+            resource = request.match_info.route.resource
+            if resource is None or resource.canonical in exempt:
+                return await handler(request)
+            await self.__admit()
+            metrics.ADMISSION_IN_FLIGHT.inc()
+            try:
+                return await handler(request)
+            except OverloadedException:
+                metrics.ADMISSION_REJECTED.labels('pool_timeout').inc()
+                raise self.__unavailable()
+            finally:
+                metrics.ADMISSION_IN_FLIGHT.dec()
+                self.__release()
+
+        return admission
+
+    def __unavailable(self):
+        return web_exceptions.HTTPServiceUnavailable(
+            text='Сервис перегружен, повторите запрос позже', headers={'Retry-After': str(max(1, math.ceil(self.__timeout)))}
+        )
+
+    async def __admit(self):
+        if self.__active < self.__limit and not self.__waiters:
+            self.__active += 1
+            return
+        if len(self.__waiters) >= self.__queue_size:
+            metrics.ADMISSION_REJECTED.labels('queue_full').inc()
+            raise self.__unavailable()
+
+        future = asyncio.get_event_loop().create_future()
+        self.__waiters.append(future)
+        metrics.ADMISSION_QUEUED.inc()
+        metrics.ADMISSION_QUEUE_DEPTH.inc()
+        started = time.perf_counter()
+        try:
+            await asyncio.wait([future], timeout=self.__timeout)
+        except asyncio.CancelledError:
+            # Клиент отключился. Если место уже было передано этому запросу, оно передаётся следующему.
+            if future.cancel():
+                self.__waiters.remove(future)
+            else:
+                self.__release()
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            metrics.ADMISSION_QUEUE_DEPTH.dec()
+            metrics.ADMISSION_QUEUE_WAIT.observe(waited)
+            profiling.record('queue', waited)
+        if future.cancel():
+            self.__waiters.remove(future)
+            metrics.ADMISSION_REJECTED.labels('timeout').inc()
+            raise self.__unavailable()
+
+    def __release(self):
+        while self.__waiters:
+            future = self.__waiters.popleft()
+            if not future.done():
+                future.set_result(True)
+                return
+        self.__active -= 1
@@ -1,40 +1,92 @@
 import accept
+import asyncio
+import base64
+import binascii
+import hmac
+import json
 import logging
+import metrics
+import re
 
 from aiohttp import web, web_exceptions
 from aiohttp_swagger import setup_swagger
-from model import ClientModel, ItemNotFoundException
+from aiohttp_swagger.helpers import generate_doc_from_each_end_point
+from cache import CachedResponse
+from model import CARD_FIELDS, CLIENT_FIELDS, ItemNotFoundException, MalformedRowException, PreconditionFailedException
 from protocol import *
-from prometheus_client import REGISTRY, exposition
+from profiling import ProfilerBusyException
+from prometheus_client import exposition
 from urllib.parse import parse_qs
 from voluptuous import MultipleInvalid
+from xml.etree import ElementTree
 
 
 class Api:
     DEFAULT_CONTENT_TYPE = "application/json"
+    STREAM_CHUNK_SIZE = 64 * 1024
+    BATCH_MAX_SIZE = 64 * 1024 * 1024
+    # Тот же предел, что client_max_size aiohttp для тел, прочитанных целиком.
+    POST_MAX_SIZE = 1024 * 1024
+    EVENTS_KEEPALIVE = 15
+    # Проверка состояния, метрики и профилирование отвечают и при перегрузке, поток событий открыт долго
+    # и не занимает место.
+    UNLIMITED_ROUTES = frozenset(['/', '/metrics', '/v1/events', '/debug/profile'])
+    # Поток событий и профилирование длятся долго по назначению, в журнал медленных запросов они не попадают.
+    LONG_ROUTES = frozenset(['/v1/events', '/debug/profile'])
+    PROFILE_MAX_SECONDS = 60
+    VARY = 'Accept, Accept-Encoding'
+    SWAGGER_URL = '/v1/docs'
+    EXPORT_CONTENT_TYPES = ('text/csv', 'application/x-ndjson')
+    # Границы типов столбцов PostgreSQL: значение вне них — ошибка запроса к базе.
+    INT_MAX = 2 ** 31 - 1
+    BIGINT_MAX = 2 ** 63 - 1
+    # Страница без stream=true целиком собирается в памяти.
+    PAGE_MAX_LIMIT = 10000
+    VERSION_TAG = re.compile(r'"([0-9]{1,10})"')
     logger = logging.getLogger(__name__)
 
-    registry = REGISTRY
+    registry = metrics.registry()
     __encoders = {
         "application/xml": XMLEncoder(),
-        "application/json": JsonEncoder()
+        "application/json": JsonEncoder(),
+        "application/x-ndjson": NdJsonEncoder()
     }
 
-    def __init__(self, host, port, transactor):
-        self.__app = web.Application()
+    def __init__(
+        self, host, port, client_model, cache, admission, feed, compressor, slow_log=None, profiler=None, debug_token=None
+    ):
+        # Журнал медленных запросов стоит до ограничения числа запросов, чтобы учесть ожидание в очереди.
+        middlewares = [metrics.middleware] + ([slow_log.middleware(self.LONG_ROUTES)] if slow_log is not None else [])
+        # Реплика для чтения выбирается после очереди, по загрузке на момент выполнения запроса.
+        self.__app = web.Application(
+            middlewares=middlewares + [admission.middleware(self.UNLIMITED_ROUTES), self.__read_scope]
+        )
         self.__host = host
         self.__port = port
         self.__app.add_routes([
             web.get('/', self.health),
             web.get('/metrics', self.metrics),
             web.get('/v1/cards', self.card_list),
+            web.get('/v1/cards/export', self.export_cards),
             web.post('/v1/cards', self.add_card),
+            web.post('/v1/cards:batch', self.add_cards),
             web.get('/v1/clients', self.client_list),
+            web.get('/v1/clients/export', self.export_clients),
             web.post('/v1/clients', self.add_client),
+            web.post('/v1/clients:batch', self.add_clients),
             web.get(r'/v1/clients/{id:\d+}/balance', self.client_balance),
-            web.put(r'/v1/cards/{id:\d+}', self.change_card)
+            web.put(r'/v1/cards/{id:\d+}', self.change_card),
+            web.get('/v1/events', self.events)
         ])
-        self.__client_model = ClientModel(transactor)
+        # Без токена профилирование недоступно.
+        if profiler is not None and debug_token:
+            self.__app.add_routes([web.get('/debug/profile', self.profile)])
+        self.__profiler = profiler
+        self.__debug_token = debug_token
+        self.__cache = cache
+        self.__client_model = client_model
+        self.__feed = feed
+        self.__compressor = compressor
 
     def __paginate(self, request):
         qs = parse_qs(request.query_string)
@@ -46,7 +98,75 @@ class Api:
         if len(limits) > 1:
             raise web_exceptions.HTTPBadRequest(text='Invalid limit value')
 
-        return int(offsets[0]), int(limits[0])
+        afters = qs.get('after', [None])
+        if len(afters) > 1:
+            raise web_exceptions.HTTPBadRequest(text='Invalid after value')
+        if afters[0] is not None and 'offset' in qs:
+            raise web_exceptions.HTTPBadRequest(text='Parameters offset and after are mutually exclusive')
+
+        after = self.__decode_cursor(afters[0]) if afters[0] is not None else None
+        offset = self.__non_negative(offsets[0], 'offset', self.BIGINT_MAX)
+        return offset, self.__non_negative(limits[0], 'limit', self.BIGINT_MAX), after
+
+    @staticmethod
+    def __non_negative(value, name, maximum):
+        try:
+            value = int(value)
+        except ValueError:
+            value = -1
+        if not 0 <= value <= maximum:
+            raise web_exceptions.HTTPBadRequest(text='Invalid {} value'.format(name))
+        return value
+
+    def __page_limit(self, limit):
+        if limit > self.PAGE_MAX_LIMIT:
+            raise web_exceptions.HTTPBadRequest(
+                text='Invalid limit value: at most {} without stream=true'.format(self.PAGE_MAX_LIMIT)
+            )
+
+    def __flag(self, request, name, default):
+        values = parse_qs(request.query_string).get(name, ['true' if default else 'false'])
+        if len(values) > 1 or values[0] not in ('true', 'false', '1', '0'):
+            raise web_exceptions.HTTPBadRequest(text='Invalid {} value'.format(name))
+        return values[0] in ('true', '1')
+
+    @staticmethod
+    def __encode_cursor(item_id):
+        return base64.urlsafe_b64encode(str(item_id).encode()).decode().rstrip('=')
+
+    @staticmethod
+    def __decode_cursor(cursor):
+        try:
+            after = int(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise web_exceptions.HTTPBadRequest(text='Invalid after value')
+        # Идентификаторы карт и клиентов — SERIAL (INTEGER).
+        if not -Api.INT_MAX - 1 <= after <= Api.INT_MAX:
+            raise web_exceptions.HTTPBadRequest(text='Invalid after value')
+        return after
+
+    def __page_headers(self, items, limit, count):
+        headers = {} if count is None else {"X-Total": str(count)}
+        if items and len(items) == limit:
+            headers["X-Next-Cursor"] = self.__encode_cursor(items[-1].id)
+        return headers
+
+    @staticmethod
+    def __etag(version):
+        return '"{}"'.format(version)
+
+    @staticmethod
+    def __if_match(request):
+        header = request.headers.get('If-Match')
+        if header is None:
+            return None
+        tags = [tag.strip() for tag in header.split(',')]
+        if '*' in tags:
+            return None
+        # Слабые, нераспознанные и большие INTEGER метки не совпадают ни с одной версией: пустой список — это 412.
+        matches = [Api.VERSION_TAG.fullmatch(tag) for tag in tags]
+        versions = [int(match.group(1)) for match in matches if match is not None]
+        return [version for version in versions if version <= Api.INT_MAX]
 
     def __choose_encoder(self, request):
         for accept_header in accept.parse(request.headers.get('Accept')):
@@ -57,23 +177,240 @@ class Api:
                 return encoder
         raise web_exceptions.HTTPNotAcceptable()
 
-    async def __decode_post(self, request):
+    @staticmethod
+    def __encode(encoder, data):
+        with metrics.encode_timer(encoder.content_type):
+            return encoder.encode(data)
+
+    @staticmethod
+    def __representation_etag(version, encoder):
+        # Метка различается для каждого формата ответа, иначе кэш клиента может отдать JSON вместо XML.
+        return '"{}-{}"'.format(version, encoder.content_type.rsplit('/', 1)[-1])
+
+    def __not_modified(self, request, etag):
+        header = request.headers.get('If-None-Match')
+        if header is None or etag is None:
+            return None
+        tags = [tag.strip() for tag in header.split(',')]
+        # If-None-Match сравнивает метки без учёта слабости: W/"1" совпадает с "1".
+        if '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]:
+            return web.HTTPNotModified(headers={'ETag': etag, 'Vary': self.VARY})
+        return None
+
+    async def __cached(self, request, key, tags, validator, produce):
+        """
+        Ответ из кэша или produce() с ETag от validator().
+
+        Версия данных читается до самих данных, поэтому метка ответа не новее его содержимого. Без If-None-Match
+        ответ из кэша отдаётся без обращения к базе с меткой, полученной при его создании.
+        """
+        entry = self.__cache.get(key)
+        if entry is None or 'If-None-Match' in request.headers:
+            etag = await validator()
+            not_modified = self.__not_modified(request, etag)
+            if not_modified is not None:
+                return not_modified
+            if entry is None or entry.headers.get('ETag') != etag:
+                generation = self.__cache.generation
+                entry = await produce()
+                if etag is not None:
+                    entry.headers['ETag'] = etag
+                self.__cache.put(key, entry, tags, generation)
+        return await self.__respond(request, entry)
+
+    async def __respond(self, request, entry):
+        headers = dict(entry.headers, Vary=self.VARY)
+        coding = self.__compressor.negotiate(request.headers.get('Accept-Encoding'), len(entry.body))
+        if coding is None:
+            return web.Response(content_type=entry.content_type, body=entry.body, headers=headers)
+        # Сжатое тело хранится в записи кэша: следующие ответы из кэша и параллельные запросы не сжимают его заново.
+        compressing = entry.compressed.get(coding)
+        if compressing is None:
+            compressing = entry.compressed[coding] = asyncio.ensure_future(self.__compressor.compress(coding, entry.body))
+            compressing.add_done_callback(lambda done: self.__compressed(entry, done))
+        body = await asyncio.shield(compressing)
+        headers['Content-Encoding'] = coding
+        if 'ETag' in headers:
+            # Сжатое тело отличается побайтно, поэтому его метка слабая, как у nginx. If-None-Match её принимает.
+            headers['ETag'] = 'W/' + headers['ETag']
+        return web.Response(content_type=entry.content_type, body=body, headers=headers)
+
+    def __compressed(self, entry, done):
+        # Сжатый вариант занимает память кэша наравне с телом.
+        if not done.cancelled() and done.exception() is None:
+            self.__cache.grow(entry, len(done.result()))
+
+    async def __stream(self, request, encoder, items, headers=None):
+        response = web.StreamResponse(headers=headers)
+        response.content_type = encoder.content_type
+        chunks = encoder.encode_stream(items)
+        buffer = bytearray()
+        # Заголовки отправляются с первой частью тела, когда строки уже читаются из базы: нехватка соединения
+        # или ошибка запроса до этого момента возвращаются обычным статусом, а не внутри тела 200.
+        try:
+            async for chunk in chunks:
+                buffer += chunk
+                if len(buffer) >= self.STREAM_CHUNK_SIZE:
+                    if not response.prepared:
+                        await response.prepare(request)
+                    await response.write(bytes(buffer))
+                    buffer.clear()
+        finally:
+            await chunks.aclose()
+            await items.aclose()
+        if not response.prepared:
+            await response.prepare(request)
+        await response.write(bytes(buffer))
+        await response.write_eof()
+        return response
+
+    def __choose_export_type(self, request):
+        for accept_header in accept.parse(request.headers.get('Accept')):
+            if accept_header.media_type == '*/*':
+                return self.EXPORT_CONTENT_TYPES[0]
+            if accept_header.media_type in self.EXPORT_CONTENT_TYPES:
+                return accept_header.media_type
+        raise web_exceptions.HTTPNotAcceptable()
+
+    async def __export(self, request, content_type, name, export):
+        response = web.StreamResponse(headers={
+            'Content-Disposition': 'attachment; filename="{}.{}"'.format(name, 'csv' if content_type == 'text/csv' else 'ndjson')
+        })
+        response.content_type = content_type
+        response.charset = 'utf-8'
+
+        # Ответ начинается с первыми данными COPY, чтобы ошибка соединения с базой вернулась обычным статусом.
+        async def output(chunk):
+            if not response.prepared:
+                await response.prepare(request)
+            await response.write(chunk)
+
+        try:
+            await export(output, content_type == 'application/x-ndjson')
+        except ConnectionResetError:
+            # Клиент закрыл соединение, COPY прерван, соединение с базой вернулось в пул.
+            self.logger.info('Export of %s interrupted by client', name)
+            return response
+        if not response.prepared:
+            await response.prepare(request)
+        await response.write_eof()
+        return response
+
+    async def __decode_post(self, request, fields):
         if request.content_type == "application/json":
-            return await request.json()
+            try:
+                return json_loads(await request.read())
+            except ValueError:
+                raise web_exceptions.HTTPBadRequest(text="Body must be a valid JSON document")
         if request.content_type == "application/xml":
-            return {"data": "xml"}
+            try:
+                return await XMLDecoder().decode(self.__limited_chunks(request, self.POST_MAX_SIZE), fields)
+            except ElementTree.ParseError as e:
+                raise web_exceptions.HTTPBadRequest(text="Body must be a valid XML document: {}".format(e))
         raise web_exceptions.HTTPBadRequest(
             text="Unknown Content-Type header. Only application/json, application/xml are allowed."
         )
 
-    async def start(self):
-        setup_swagger(self.__app, swagger_url='/v1/docs')
+    async def __decode_batch(self, request, fields):
+        if request.content_type == "application/json":
+            body = bytearray()
+            async for chunk in self.__limited_chunks(request, self.BATCH_MAX_SIZE):
+                body += chunk
+            try:
+                rows = json_loads(body)
+            except ValueError:
+                rows = None
+            if not isinstance(rows, list):
+                raise web_exceptions.HTTPBadRequest(text="Batch body must be a JSON array")
+            for data in rows:
+                yield data
+        elif request.content_type in ("application/x-ndjson", "application/xml"):
+            if request.content_type == "application/xml":
+                rows = XMLDecoder().decode_stream(self.__limited_chunks(request, self.BATCH_MAX_SIZE), fields)
+            else:
+                rows = self.__ndjson_rows(self.__limited_chunks(request, self.BATCH_MAX_SIZE))
+            # Потоковый пакет к этому моменту уже частично записан, поэтому ошибка всего тела не отменяет
+            # результат, а завершает его ошибочной строкой с причиной.
+            try:
+                async for data in rows:
+                    yield data
+            except ElementTree.ParseError as e:
+                yield MalformedRowException('Invalid XML: {}'.format(e))
+            except web_exceptions.HTTPRequestEntityTooLarge:
+                yield MalformedRowException(
+                    'Batch body exceeds {} bytes, the rest of it is not processed'.format(self.BATCH_MAX_SIZE)
+                )
+        else:
+            raise web_exceptions.HTTPBadRequest(
+                text="Unknown Content-Type header. Only application/json, application/x-ndjson, application/xml are allowed."
+            )
+
+    async def __ndjson_rows(self, chunks):
+        buffer = bytearray()
+        async for chunk in chunks:
+            start = len(buffer)
+            buffer += chunk
+            end = buffer.rfind(b'\n', start)
+            if end < 0:
+                continue
+            lines = bytes(buffer[:end]).split(b'\n')
+            del buffer[:end + 1]
+            for line in lines:
+                row = self.__ndjson_row(line)
+                if row is not None:
+                    yield row
+        row = self.__ndjson_row(bytes(buffer))
+        if row is not None:
+            yield row
+
+    @staticmethod
+    def __ndjson_row(line):
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            return json_loads(line)
+        except ValueError as e:
+            return MalformedRowException('Invalid JSON: {}'.format(e))
+
+    async def __limited_chunks(self, request, limit):
+        size = 0
+        async for chunk in request.content.iter_chunked(self.STREAM_CHUNK_SIZE):
+            size += len(chunk)
+            if size > limit:
+                raise web_exceptions.HTTPRequestEntityTooLarge(limit, size)
+            yield chunk
+
+    def __lazy_swagger(self, _):
+        # Описание собирается из docstring всех обработчиков при первом запросе /v1/docs, а не при запуске.
+        spec = None
+
+        async def swagger_def(_):
+            nonlocal spec
+            if spec is None:
+                # К этому моменту в приложении есть и маршруты самой документации, в описание они не входят.
+                swagger = json.loads(generate_doc_from_each_end_point(self.__app))
+                swagger['paths'] = {
+                    path: doc for (path, doc) in swagger['paths'].items() if not path.startswith(self.SWAGGER_URL)
+                }
+                spec = json.dumps(swagger)
+            return web.json_response(text=spec)
+
+        return swagger_def
+
+    async def start(self, reuse_port=False):
+        setup_swagger(self.__app, swagger_url=self.SWAGGER_URL, swagger_info={}, swagger_def_decor=self.__lazy_swagger)
         runner = web.AppRunner(self.__app)
         await runner.setup()
-        service = web.TCPSite(runner, self.__host, self.__port)
+        service = web.TCPSite(runner, self.__host, self.__port, reuse_port=reuse_port)
         await service.start()
         self.logger.info('Service is started at %s:%s', self.__host, self.__port)
 
+    @web.middleware
+    async def __read_scope(self, request, handler):
+        self.__client_model.begin_read()
+        return await handler(request)
+
     async def health(self, _):
         """
         ---
@@ -104,6 +441,57 @@ class Api:
         scrape = encoder(self.registry)
         return web.Response(headers=dict([('Content-Type', content_type)]), body=scrape)
 
+    async def profile(self, request):
+        """
+        ---
+        description: Профилирование процесса, принявшего запрос, по выборкам стека цикла событий
+        tags:
+        - Debug
+        produces:
+        - text/plain
+        parameters:
+        - name: Authorization
+          in: header
+          description: Bearer и значение DEBUG_TOKEN
+          required: true
+          type: string
+        - name: seconds
+          in: query
+          description: длительность профилирования в секундах, от 1 до 60. По умолчанию 10
+          required: false
+          type: integer
+        - name: interval
+          in: query
+          description: интервал между выборками в миллисекундах, от 1 до 1000. По умолчанию 10
+          required: false
+          type: integer
+        responses:
+            "200":
+                description: успех. Свёрнутые стеки для flamegraph.pl или speedscope, по строке на стек с числом выборок
+            "400":
+                description: ошибка клиента. Указаны неверные параметры
+            "401":
+                description: ошибка клиента. Неверный токен
+            "409":
+                description: ошибка. Профилирование уже выполняется
+        """
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if scheme != 'Bearer' or not hmac.compare_digest(token.encode(), self.__debug_token.encode()):
+            raise web_exceptions.HTTPUnauthorized(text='Invalid debug token', headers={'WWW-Authenticate': 'Bearer'})
+        qs = parse_qs(request.query_string)
+        try:
+            seconds = int(qs.get('seconds', [10])[-1])
+            interval = int(qs.get('interval', [10])[-1])
+        except ValueError:
+            raise web_exceptions.HTTPBadRequest(text='Invalid seconds or interval value')
+        if not 1 <= seconds <= self.PROFILE_MAX_SECONDS or not 1 <= interval <= 1000:
+            raise web_exceptions.HTTPBadRequest(text='Invalid seconds or interval value')
+        try:
+            stacks = await self.__profiler.profile(seconds, interval / 1000)
+        except ProfilerBusyException as e:
+            raise web_exceptions.HTTPConflict(text=str(e))
+        return web.Response(text=stacks)
+
     async def card_list(self, request):
         """
         ---
@@ -113,6 +501,7 @@ class Api:
         produces:
         - application/json
         - application/xml
+        - application/x-ndjson
         parameters:
         - name: offset
           in: query
@@ -121,19 +510,110 @@ class Api:
           type: integer
         - name: limit
           in: query
-          description: Pagination limit
+          description: Pagination limit, at most 10000 without stream=true
           required: false
           type: integer
+        - name: after
+          in: query
+          description: Pagination cursor from the X-Next-Cursor header of the previous page
+          required: false
+          type: string
+        - name: total
+          in: query
+          description: Set to false to skip the X-Total header
+          required: false
+          type: boolean
+        - name: stream
+          in: query
+          description: Set to true to stream the page in chunks without X-Total and X-Next-Cursor headers
+          required: false
+          type: boolean
+        - name: If-None-Match
+          in: header
+          description: ETag из предыдущего ответа. Если данные не изменились, возвращается 304 без тела
+          required: false
+          type: string
         responses:
             "200":
                 description: успех. Возвращает список карт клиентов
+            "304":
+                description: данные не изменились с получения ETag из If-None-Match
             "406":
                 description: ошибка клиента. Указан неверный Accept
         """
         encoder = self.__choose_encoder(request)
-        offset, limit = self.__paginate(request)
-        cards, count = await self.__client_model.all_cards(offset, limit)
-        return web.Response(content_type=encoder.content_type, body=encoder.encode(cards), headers={"X-Total": str(count)})
+        offset, limit, after = self.__paginate(request)
+        if self.__flag(request, 'stream', False):
+            etag = self.__representation_etag(await self.__client_model.cards_version(), encoder)
+            not_modified = self.__not_modified(request, etag)
+            if not_modified is not None:
+                return not_modified
+            return await self.__stream(
+                request, encoder, self.__client_model.stream_cards(offset, limit, after), {'ETag': etag, 'Vary': 'Accept'}
+            )
+        self.__page_limit(limit)
+        total = self.__flag(request, 'total', True)
+
+        async def produce():
+            cards, count = await self.__client_model.all_cards(offset, limit, after, total)
+            return CachedResponse(encoder.content_type, self.__encode(encoder, cards), self.__page_headers(cards, limit, count))
+
+        async def validator():
+            return self.__representation_etag(await self.__client_model.cards_version(), encoder)
+
+        return await self.__cached(
+            request, ('card_list', offset, limit, after, total, encoder.content_type), ('cards',), validator, produce
+        )
+
+    async def export_cards(self, request):
+        """
+        ---
+        description: Выгрузка всех карт одним потоком через COPY, без пагинации и подсчёта
+        tags:
+        - Cards
+        produces:
+        - text/csv
+        - application/x-ndjson
+        parameters:
+        - name: owner_id
+          in: query
+          description: идентификатор владельца, можно указать несколько раз
+          required: false
+          type: integer
+        - name: currency
+          in: query
+          description: валюта карты, можно указать несколько раз
+          required: false
+          type: string
+        - name: payment_system
+          in: query
+          description: платежная система, можно указать несколько раз
+          required: false
+          type: string
+        responses:
+            "200":
+                description: успех. Возвращает карты в порядке идентификатора, CSV с заголовком или NDJSON
+            "400":
+                description: ошибка клиента. Указаны неверные параметры
+            "406":
+                description: ошибка клиента. Указан неверный Accept
+        """
+        content_type = self.__choose_export_type(request)
+        qs = parse_qs(request.query_string)
+        try:
+            owner_ids = [int(owner_id) for owner_id in qs['owner_id']] if 'owner_id' in qs else None
+        except ValueError:
+            raise web_exceptions.HTTPBadRequest(text='Invalid owner_id value')
+        # cards.owner_id — BIGINT.
+        if owner_ids is not None and not all(-self.BIGINT_MAX - 1 <= owner_id <= self.BIGINT_MAX for owner_id in owner_ids):
+            raise web_exceptions.HTTPBadRequest(text='Invalid owner_id value')
+
+        async def export(output, ndjson):
+            await self.__client_model.export_cards(
+                output, ndjson, owner_ids, qs.get('currency'), qs.get('payment_system')
+            )
+
+        return await self.__export(request, content_type, 'cards', export)
 
     async def add_card(self, request):
         """
@@ -170,22 +650,59 @@ class Api:
                 required: true
         responses:
             "200":
-                description: успех. Возвращает данные новой карты клиента
+                description: успех. Возвращает данные новой карты клиента, ETag содержит её версию
             "404":
                 description: ошибка. Клиент не найден
             "406":
                 description: ошибка клиента. Указан неверный Accept
         """
         encoder = self.__choose_encoder(request)
-        data = await self.__decode_post(request)
+        data = await self.__decode_post(request, CARD_FIELDS)
         try:
-            card = await self.__client_model.add_card(data)
-            return web.HTTPCreated(content_type=encoder.content_type, body=encoder.encode(card))
+            card, version = await self.__client_model.add_card(data)
+            return web.HTTPCreated(
+                content_type=encoder.content_type, body=self.__encode(encoder, card), headers={'ETag': self.__etag(version)}
+            )
         except MultipleInvalid as e:
             raise web_exceptions.HTTPBadRequest(text=str(e))
         except ItemNotFoundException as e:
             raise web_exceptions.HTTPNotFound(text=str(e))
 
+    async def add_cards(self, request):
+        """
+        ---
+        description: Запрос для пакетного добавления карт клиентов. Принимает JSON-массив, поток NDJSON или XML-документ со списком item
+        tags:
+        - Cards
+        consumes:
+        - application/json
+        - application/x-ndjson
+        - application/xml
+        produces:
+        - application/json
+        - application/xml
+        - application/x-ndjson
+        parameters:
+        - name: cards
+          in: body
+          description: данные новых карт в формате POST /v1/cards
+          required: true
+          schema:
+            type: array
+            items:
+              type: object
+        responses:
+            "200":
+                description: успех. Возвращает результат по каждой строке (created, invalid, not_found)
+            "400":
+                description: ошибка клиента. Неверный формат тела запроса
+            "406":
+                description: ошибка клиента. Указан неверный Accept
+        """
+        encoder = self.__choose_encoder(request)
+        results = await self.__client_model.add_cards(self.__decode_batch(request, CARD_FIELDS))
+        return await self.__respond(request, CachedResponse(encoder.content_type, self.__encode(encoder, results), {}))
+
     async def client_list(self, request):
         """
         ---
@@ -195,6 +712,7 @@ class Api:
         produces:
         - application/json
         - application/xml
+        - application/x-ndjson
         parameters:
         - name: offset
           in: query
@@ -203,19 +721,78 @@ class Api:
           type: integer
         - name: limit
           in: query
-          description: Pagination limit
+          description: Pagination limit, at most 10000 without stream=true
           required: false
           type: integer
+        - name: after
+          in: query
+          description: Pagination cursor from the X-Next-Cursor header of the previous page
+          required: false
+          type: string
+        - name: total
+          in: query
+          description: Set to false to skip the X-Total header
+          required: false
+          type: boolean
+        - name: stream
+          in: query
+          description: Set to true to stream the page in chunks without X-Total and X-Next-Cursor headers
+          required: false
+          type: boolean
+        - name: If-None-Match
+          in: header
+          description: ETag из предыдущего ответа. Если данные не изменились, возвращается 304 без тела
+          required: false
+          type: string
         responses:
             "200":
                 description: успех. Возвращает список клиентов
+            "304":
+                description: данные не изменились с получения ETag из If-None-Match
             "406":
                 description: ошибка клиента. Указан неверный Accept
         """
         encoder = self.__choose_encoder(request)
-        offset, limit = self.__paginate(request)
-        clients, count = await self.__client_model.all_clients(offset, limit)
-        return web.Response(content_type=encoder.content_type, body=encoder.encode(clients), headers={"X-Total": str(count)})
+        offset, limit, after = self.__paginate(request)
+        if self.__flag(request, 'stream', False):
+            etag = self.__representation_etag(await self.__client_model.clients_version(), encoder)
+            not_modified = self.__not_modified(request, etag)
+            if not_modified is not None:
+                return not_modified
+            return await self.__stream(
+                request, encoder, self.__client_model.stream_clients(offset, limit, after), {'ETag': etag, 'Vary': 'Accept'}
+            )
+        self.__page_limit(limit)
+        total = self.__flag(request, 'total', True)
+
+        async def produce():
+            clients, count = await self.__client_model.all_clients(offset, limit, after, total)
+            return CachedResponse(encoder.content_type, self.__encode(encoder, clients), self.__page_headers(clients, limit, count))
+
+        async def validator():
+            return self.__representation_etag(await self.__client_model.clients_version(), encoder)
+
+        return await self.__cached(
+            request, ('client_list', offset, limit, after, total, encoder.content_type), ('clients',), validator, produce
+        )
+
+    async def export_clients(self, request):
+        """
+        ---
+        description: Выгрузка всех клиентов (идентификатор и имя) одним потоком через COPY, без пагинации и подсчёта
+        tags:
+        - Clients
+        produces:
+        - text/csv
+        - application/x-ndjson
+        responses:
+            "200":
+                description: успех. Возвращает клиентов в порядке идентификатора, CSV с заголовком или NDJSON
+            "406":
+                description: ошибка клиента. Указан неверный Accept
+        """
+        content_type = self.__choose_export_type(request)
+        return await self.__export(request, content_type, 'clients', self.__client_model.export_clients)
 
     async def add_client(self, request):
         """
@@ -244,13 +821,48 @@ class Api:
                 description: ошибка клиента. Указан неверный Accept
         """
         encoder = self.__choose_encoder(request)
-        data = await self.__decode_post(request)
+        data = await self.__decode_post(request, CLIENT_FIELDS)
         try:
             client = await self.__client_model.add_client(data)
-            return web.HTTPCreated(content_type=encoder.content_type, body=encoder.encode(client))
+            return web.HTTPCreated(content_type=encoder.content_type, body=self.__encode(encoder, client))
         except MultipleInvalid as e:
             raise web_exceptions.HTTPBadRequest(text=str(e))
 
+    async def add_clients(self, request):
+        """
+        ---
+        description: Запрос для пакетного добавления клиентов. Принимает JSON-массив, поток NDJSON или XML-документ со списком item
+        tags:
+        - Clients
+        consumes:
+        - application/json
+        - application/x-ndjson
+        - application/xml
+        produces:
+        - application/json
+        - application/xml
+        - application/x-ndjson
+        parameters:
+        - name: clients
+          in: body
+          description: данные новых клиентов в формате POST /v1/clients
+          required: true
+          schema:
+            type: array
+            items:
+              type: object
+        responses:
+            "200":
+                description: успех. Возвращает результат по каждой строке (created, invalid)
+            "400":
+                description: ошибка клиента. Неверный формат тела запроса
+            "406":
+                description: ошибка клиента. Указан неверный Accept
+        """
+        encoder = self.__choose_encoder(request)
+        results = await self.__client_model.add_clients(self.__decode_batch(request, CLIENT_FIELDS))
+        return await self.__respond(request, CachedResponse(encoder.content_type, self.__encode(encoder, results), {}))
+
     async def client_balance(self, request):
         """
         ---
@@ -266,9 +878,21 @@ class Api:
           description: идентификатор клиента
           required: false
           type: integer
+        - name: cards
+          in: query
+          description: Set to true to include the client's cards
+          required: false
+          type: boolean
+        - name: If-None-Match
+          in: header
+          description: ETag из предыдущего ответа. Если данные не изменились, возвращается 304 без тела
+          required: false
+          type: string
         responses:
             "200":
-                description: успех. Возвращает данные нового клиента
+                description: успех. Возвращает баланс клиента
+            "304":
+                description: данные не изменились с получения ETag из If-None-Match
             "404":
                 description: ошибка. Клиент не найден
             "406":
@@ -276,8 +900,23 @@ class Api:
         """
         client_id = int(request.match_info.get('id'))
         encoder = self.__choose_encoder(request)
-        client = await self.__client_model.client_balance(client_id)
-        return web.Response(content_type=encoder.content_type, body=encoder.encode(client))
+        with_cards = self.__flag(request, 'cards', False)
+
+        async def produce():
+            client = await self.__client_model.client_balance(client_id, with_cards)
+            return CachedResponse(encoder.content_type, self.__encode(encoder, client), {})
+
+        async def validator():
+            version = await self.__client_model.balance_version(client_id)
+            return self.__representation_etag(version, encoder) if version is not None else None
+
+        try:
+            return await self.__cached(
+                request, ('client_balance', client_id, with_cards, encoder.content_type), (('balance', client_id),),
+                validator, produce
+            )
+        except ItemNotFoundException as e:
+            raise web_exceptions.HTTPNotFound(text=str(e))
 
     async def change_card(self, request):
         """
@@ -294,6 +933,11 @@ class Api:
           description: идентификатор карты
           required: true
           type: integer
+        - name: If-Match
+          in: header
+          description: ETag карты из предыдущего ответа. Изменение применяется, только если карта с тех пор не менялась
+          required: false
+          type: string
         - name: card
           in: body
           description: данные карты
@@ -315,19 +959,90 @@ class Api:
                 description: баланс карты
         responses:
             "200":
-                description: успех. Возвращает измененные данные карты
+                description: успех. Возвращает измененные данные карты, ETag содержит новую версию
             "400":
                 description: ошибка клиента. Указаны неверные данные карты
             "404":
-                description: ошибка. Карта не найдена
+                description: ошибка. Карта или новый владелец не найдены
             "406":
                 description: ошибка клиента. Указан неверный Accept
+            "412":
+                description: ошибка. Карта изменена после получения ETag из If-Match
         """
         card_id = int(request.match_info.get('id'))
         encoder = self.__choose_encoder(request)
-        data = await self.__decode_post(request)
+        data = await self.__decode_post(request, CARD_FIELDS)
         try:
-            card = await self.__client_model.change_card(card_id, data)
-            return web.Response(content_type=encoder.content_type, body=encoder.encode(card))
+            card, version = await self.__client_model.change_card(card_id, data, self.__if_match(request))
+            return web.Response(
+                content_type=encoder.content_type, body=self.__encode(encoder, card), headers={'ETag': self.__etag(version)}
+            )
         except MultipleInvalid as e:
             raise web_exceptions.HTTPBadRequest(text=str(e))
+        except ItemNotFoundException as e:
+            raise web_exceptions.HTTPNotFound(text=str(e))
+        except PreconditionFailedException as e:
+            raise web_exceptions.HTTPPreconditionFailed(text=str(e))
+
+    async def events(self, request):
+        """
+        ---
+        description: Поток изменений карт и клиентов в формате Server-Sent Events
+        tags:
+        - Events
+        produces:
+        - text/event-stream
+        parameters:
+        - name: table
+          in: query
+          description: cards или clients, можно указать несколько раз. По умолчанию все изменения
+          required: false
+          type: string
+        - name: client_id
+          in: query
+          description: идентификатор клиента, можно указать несколько раз. По умолчанию все клиенты
+          required: false
+          type: integer
+        - name: Last-Event-ID
+          in: header
+          description: номер последнего полученного события, поток продолжается с него
+          required: false
+          type: integer
+        - name: last_event_id
+          in: query
+          description: то же, что Last-Event-ID, для первого подключения
+          required: false
+          type: integer
+        responses:
+            "200":
+                description: успех. События cards и clients с полями seq, table, op, client_id, previous_client_id
+                    и item. Событие reset означает, что часть изменений могла быть пропущена
+            "400":
+                description: ошибка клиента. Указаны неверные параметры
+        """
+        qs = parse_qs(request.query_string)
+        tables = frozenset(qs.get('table', []))
+        if not tables <= {'cards', 'clients'}:
+            raise web_exceptions.HTTPBadRequest(text='Invalid table value')
+        last_event_id = request.headers.get('Last-Event-ID', qs.get('last_event_id', [None])[-1])
+        try:
+            client_ids = frozenset(int(client_id) for client_id in qs.get('client_id', []))
+            last_event_id = int(last_event_id) if last_event_id is not None else None
+        except ValueError:
+            raise web_exceptions.HTTPBadRequest(text='Invalid client_id or last_event_id value')
+
+        response = web.StreamResponse(headers={'Cache-Control': 'no-cache'})
+        response.content_type = 'text/event-stream'
+        await response.prepare(request)
+        subscription = self.__feed.subscribe(tables, client_ids, last_event_id)
+        try:
+            while not subscription.overflowed:
+                frame = await subscription.get(self.EVENTS_KEEPALIVE)
+                if frame is not None:
+                    await response.write(frame)
+                elif not subscription.overflowed:
+                    await response.write(b': keep-alive\n\n')
+        finally:
+            self.__feed.unsubscribe(subscription)
+        await response.write_eof()
+        return response
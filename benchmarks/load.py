@@ -0,0 +1,204 @@
+"""
+Нагрузочный тест всех маршрутов Api.
+
+Поднимает временный PostgreSQL (или использует --dsn), применяет миграции, наполняет базу, запускает сервис
+отдельным процессом и по очереди нагружает каждый маршрут для каждого кодировщика заданным числом
+одновременных клиентов. Выводит число запросов в секунду и задержку p50/p99.
+
+Запуск: python benchmarks/load.py --clients 10000 --cards-per-client 10 --concurrency 32 --duration 10
+Переменные окружения сервиса (например, RESPONSE_CACHE_SIZE=0) передаются ему без изменений.
+"""
+import aiohttp
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from benchmarks.postgres import LocalPostgres, free_port, seed  # noqa: E402
+
+ACCEPTS = ['application/json', 'application/xml', 'application/x-ndjson']
+EXPORT_ACCEPTS = ['text/csv', 'application/x-ndjson']
+
+
+class Scenario:
+    def __init__(self, name, method, path, body=None, accepts=ACCEPTS[:1], headers_only=False):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self.accepts = accepts
+        # Для бесконечных потоков измеряется время до заголовков ответа, после чего соединение закрывается.
+        self.headers_only = headers_only
+
+
+def cursor(item_id):
+    return base64.urlsafe_b64encode(str(item_id).encode()).decode().rstrip('=')
+
+
+def card_body(max_client):
+    return {
+        'owner_id': random.randint(1, max_client),
+        'payment_system': 'Visa',
+        'currency': 'RUB',
+        'balance': round(random.uniform(0, 1000), 2)
+    }
+
+
+def scenarios(max_client, max_card):
+    return [
+        Scenario('GET /', 'GET', lambda: '/'),
+        Scenario('GET /metrics', 'GET', lambda: '/metrics'),
+        Scenario('GET /v1/cards offset', 'GET', lambda: '/v1/cards?offset={}&limit=20'.format(
+            random.randint(0, max_card - 20)), accepts=ACCEPTS),
+        Scenario('GET /v1/cards after', 'GET', lambda: '/v1/cards?after={}&limit=20'.format(
+            cursor(random.randint(0, max_card - 20))), accepts=ACCEPTS),
+        Scenario('GET /v1/cards stream', 'GET', lambda: '/v1/cards?after={}&limit=1000&stream=true'.format(
+            cursor(random.randint(0, max_card - 1000))), accepts=ACCEPTS),
+        Scenario('GET /v1/clients offset', 'GET', lambda: '/v1/clients?offset={}&limit=20'.format(
+            random.randint(0, max_client - 20)), accepts=ACCEPTS),
+        Scenario('GET /v1/clients after', 'GET', lambda: '/v1/clients?after={}&limit=20'.format(
+            cursor(random.randint(0, max_client - 20))), accepts=ACCEPTS),
+        Scenario('GET /v1/clients stream', 'GET', lambda: '/v1/clients?after={}&limit=1000&stream=true'.format(
+            cursor(random.randint(0, max_client - 1000))), accepts=ACCEPTS),
+        Scenario('GET /v1/clients/{id}/balance', 'GET', lambda: '/v1/clients/{}/balance'.format(
+            random.randint(1, max_client)), accepts=ACCEPTS),
+        Scenario('GET /v1/clients/{id}/balance cards', 'GET', lambda: '/v1/clients/{}/balance?cards=true'.format(
+            random.randint(1, max_client)), accepts=ACCEPTS),
+        Scenario('POST /v1/cards', 'POST', lambda: '/v1/cards', lambda: card_body(max_client)),
+        Scenario('PUT /v1/cards/{id}', 'PUT', lambda: '/v1/cards/{}'.format(random.randint(1, max_card)),
+                 lambda: {'balance': round(random.uniform(0, 1000), 2)}),
+        Scenario('POST /v1/clients', 'POST', lambda: '/v1/clients', lambda: {'name': 'Клиент'}),
+        Scenario('POST /v1/cards:batch', 'POST', lambda: '/v1/cards:batch',
+                 lambda: [card_body(max_client) for _ in range(100)]),
+        Scenario('POST /v1/clients:batch', 'POST', lambda: '/v1/clients:batch',
+                 lambda: [{'name': 'Клиент'} for _ in range(100)]),
+        Scenario('GET /v1/cards/export', 'GET', lambda: '/v1/cards/export?owner_id={}'.format(
+            random.randint(1, max_client)), accepts=EXPORT_ACCEPTS),
+        Scenario('GET /v1/clients/export', 'GET', lambda: '/v1/clients/export', accepts=EXPORT_ACCEPTS),
+        Scenario('GET /v1/events subscribe', 'GET', lambda: '/v1/events?client_id={}'.format(
+            random.randint(1, max_client)), accepts=['text/event-stream'], headers_only=True),
+    ]
+
+
+async def drive(session, base_url, scenario, accept, concurrency, duration):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def client():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            body = scenario.body() if scenario.body is not None else None
+            started = time.perf_counter()
+            try:
+                async with session.request(
+                    scenario.method, base_url + scenario.path(), headers={'Accept': accept},
+                    data=json.dumps(body) if body is not None else None,
+                    skip_auto_headers=['Content-Type'] if body is None else None,
+                ) as response:
+                    if not scenario.headers_only:
+                        await response.read()
+                    if response.status >= 400:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'endpoint': scenario.name,
+        'accept': accept,
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed,
+        'p50_ms': latencies[int(0.50 * (len(latencies) - 1))] * 1000 if latencies else 0,
+        'p99_ms': latencies[int(0.99 * (len(latencies) - 1))] * 1000 if latencies else 0,
+    }
+
+
+async def wait_ready(base_url, process):
+    async with aiohttp.ClientSession() as session:
+        for _ in range(300):
+            if process.returncode is not None:
+                raise RuntimeError('Service exited with code {}'.format(process.returncode))
+            try:
+                async with session.get(base_url + '/') as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError('Service did not start')
+
+
+async def run(args, dsn):
+    from main import migrate
+
+    os.chdir(ROOT)
+    migrate(dsn)
+    max_client, max_card = await seed(dsn, args.clients, args.cards_per_client)
+
+    port = free_port()
+    env = dict(os.environ, DB_DSN=dsn, SERVER_HOST='127.0.0.1', SERVER_PORT=str(port), SERVER_WORKERS=str(args.workers))
+    with open(args.log, 'w') as log:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, 'main.py', env=env, stdout=log, stderr=log, cwd=ROOT
+        )
+    base_url = 'http://127.0.0.1:{}'.format(port)
+    results = []
+    try:
+        await wait_ready(base_url, process)
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        async with aiohttp.ClientSession(connector=connector, headers={'Content-Type': 'application/json'}) as session:
+            for scenario in scenarios(max_client, max_card):
+                if args.only and args.only not in scenario.name:
+                    continue
+                for accept in scenario.accepts:
+                    result = await drive(session, base_url, scenario, accept, args.concurrency, args.duration)
+                    results.append(result)
+                    print('{endpoint:<38} {accept:<22} {requests:>8} {errors:>6} {rps:>10.1f} {p50_ms:>9.2f} {p99_ms:>9.2f}'
+                          .format(**result), flush=True)
+    finally:
+        process.terminate()
+        await process.wait()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', help='existing database to use instead of a temporary PostgreSQL')
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--cards-per-client', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=1, help='SERVER_WORKERS of the service')
+    parser.add_argument('--only', help='run only endpoints whose name contains this string')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--log', default=os.devnull, help='service log file')
+    args = parser.parse_args()
+
+    print('{:<38} {:<22} {:>8} {:>6} {:>10} {:>9} {:>9}'.format(
+        'endpoint', 'accept', 'requests', 'errors', 'rps', 'p50, ms', 'p99, ms'
+    ))
+    if args.dsn:
+        results = asyncio.run(run(args, args.dsn))
+    else:
+        with LocalPostgres() as dsn:
+            results = asyncio.run(run(args, dsn))
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Стоимость отображения строк в объекты модели на страницах /v1/cards.
+
+Сравнивает прежнее отображение (столбцы по имени, NUMERIC в Decimal и float() на каждую строку, замороженный
+датакласс с __dict__) с RowMapper: построчным (слоты, столбцы по позиции, NUMERIC сразу в float) и по столбцам
+(model.Columns). Для каждого способа выводится время чтения строк, время отображения, размер результата в памяти
+на строку и время кодирования в JSON.
+
+Поднимает временный PostgreSQL (или использует --dsn), применяет миграции и наполняет базу.
+Запуск: python benchmarks/mapping.py --rows 100000
+"""
+import argparse
+import asyncio
+import asyncpg
+import dataclasses
+import gc
+import os
+import sys
+import timeit
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from benchmarks.postgres import LocalPostgres, seed  # noqa: E402
+
+REPEATS = 5
+CARDS_PER_CLIENT = 5
+
+
+@dataclasses.dataclass(frozen=True)
+class LegacyCard:
+    id: int
+    owner_id: int
+    payment_system: str
+    currency: str
+    balance: float
+
+
+def legacy_cards(records):
+    return [LegacyCard(
+        id=record['id'],
+        owner_id=record['owner_id'],
+        payment_system=record['payment_system'],
+        currency=record['currency'],
+        balance=float(record['balance'])
+    ) for record in records]
+
+
+async def fetch_ms(conn, query, rows):
+    timings = []
+    for _ in range(REPEATS):
+        started = timeit.default_timer()
+        await conn.fetch(query, rows)
+        timings.append(timeit.default_timer() - started)
+    return min(timings) * 1000
+
+
+def retained(build, records):
+    # Память, которую занимает результат (без самих строк asyncpg), в пересчёте на строку.
+    gc.collect()
+    tracemalloc.start()
+    result = build(records)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size / len(records)
+
+
+async def run(args, dsn):
+    from main import migrate
+    from database import CARD_COLUMNS, CARD_MAPPER, prepare_statements
+    from protocol import JsonEncoder
+
+    os.chdir(ROOT)
+    migrate(dsn)
+    await seed(dsn, args.rows // CARDS_PER_CLIENT, CARDS_PER_CLIENT)
+
+    query = 'SELECT {} FROM cards ORDER BY id LIMIT $1'.format(CARD_COLUMNS)
+    legacy_conn = await asyncpg.connect(dsn)
+    conn = await asyncpg.connect(dsn)
+    try:
+        await prepare_statements(conn)
+        legacy_records = await legacy_conn.fetch(query, args.rows)
+        records = await conn.fetch(query, args.rows)
+        # NUMERIC декодируется при чтении: Decimal у прежнего соединения, float с кодеком prepare_statements.
+        legacy_fetch_ms = await fetch_ms(legacy_conn, query, args.rows)
+        fetch = await fetch_ms(conn, query, args.rows)
+    finally:
+        await legacy_conn.close()
+        await conn.close()
+
+    encoder = JsonEncoder()
+    variants = [
+        ('legacy', legacy_cards, legacy_records, legacy_fetch_ms),
+        ('rows', CARD_MAPPER.many, records, fetch),
+        ('columns', CARD_MAPPER.columns, records, fetch),
+    ]
+    print('{} rows'.format(len(records)))
+    print('{:<10} {:>10} {:>10} {:>10} {:>12} {:>10}'.format(
+        'mapping', 'fetch, ms', 'map, ms', 'ns/row', 'bytes/row', 'json, ms'
+    ))
+    for name, build, source, fetched_ms in variants:
+        map_ms = min(timeit.repeat(lambda: build(source), number=1, repeat=REPEATS)) * 1000
+        page = build(source)
+        json_ms = min(timeit.repeat(lambda: encoder.encode(page), number=1, repeat=REPEATS)) * 1000
+        print('{:<10} {:>10.2f} {:>10.2f} {:>10.0f} {:>12.1f} {:>10.2f}'.format(
+            name, fetched_ms, map_ms, map_ms * 1e6 / len(source), retained(build, source), json_ms
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', help='existing database to use instead of a temporary PostgreSQL')
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.dsn:
+        asyncio.run(run(args, args.dsn))
+    else:
+        with LocalPostgres() as dsn:
+            asyncio.run(run(args, dsn))
+
+
+if __name__ == '__main__':
+    main()
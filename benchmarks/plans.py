@@ -0,0 +1,121 @@
+"""
+Проверка планов запросов database.STATEMENTS.
+
+Поднимает временный PostgreSQL (или использует --dsn), применяет миграции, наполняет базу и выполняет EXPLAIN
+для каждого запроса с типичными параметрами, по отдельности для custom и generic плана (подготовленные запросы
+после нескольких выполнений переходят на generic план). Завершается с кодом 1, если какой-либо план читает
+таблицу последовательным сканированием (кроме служебных таблиц из нескольких строк).
+
+Запуск: python benchmarks/plans.py --clients 20000 --cards-per-client 5
+"""
+import argparse
+import asyncio
+import asyncpg
+import json
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from benchmarks.postgres import LocalPostgres, seed  # noqa: E402
+
+PLAN_CACHE_MODES = ('force_custom_plan', 'force_generic_plan')
+# В таблице по строке на таблицу данных, последовательное сканирование для неё дешевле индекса.
+SMALL_TABLES = frozenset(['row_counts'])
+
+
+def sample_args(max_client, max_card):
+    client, card = max_client // 2, max_card // 2
+    clients = list(range(client, client + 20))
+    return {
+        'all_cards': (1000, 20),
+        'all_cards_after': (card, 20),
+        'all_cards_by_client_id': (client,),
+        'all_cards_by_owner_ids': (clients,),
+        'add_card': (client, 'Visa', 'RUB', 1.0),
+        'add_cards': ([client] * 100, ['Visa'] * 100, ['RUB'] * 100, [1.0] * 100),
+        'change_card': (card, None, None, None, 1.0, None),
+        'card_version': (card,),
+        'all_clients': (1000, 20),
+        'all_clients_after': (client, 20),
+        'client_by_id': (client,),
+        'client_balances': (clients,),
+        'table_versions': (['cards', 'clients'],),
+        'balance_versions': (clients,),
+        'add_clients': (['Клиент'] * 100,),
+        'add_client': ('Клиент',),
+    }
+
+
+def literal(value):
+    # Параметры EXECUTE передаются текстом: тип каждого берётся из подготовленного запроса.
+    if value is None:
+        return 'NULL'
+    if isinstance(value, list):
+        value = '{' + ','.join('"{}"'.format(str(item).replace('\\', '\\\\').replace('"', '\\"')) for item in value) + '}'
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def seq_scans(plan):
+    if plan['Node Type'] == 'Seq Scan':
+        yield plan['Relation Name']
+    for child in plan.get('Plans', []):
+        yield from seq_scans(child)
+
+
+async def check(dsn, max_client, max_card):
+    from database import STATEMENTS
+
+    samples = sample_args(max_client, max_card)
+    failures = 0
+    conn = await asyncpg.connect(dsn)
+    try:
+        for name, query in STATEMENTS.items():
+            if name not in samples:
+                print('{:<24} no sample arguments in benchmarks/plans.py'.format(name))
+                failures += 1
+                continue
+            await conn.execute('PREPARE plan_check AS ' + query)
+            for mode in PLAN_CACHE_MODES:
+                await conn.execute('SET plan_cache_mode = {}'.format(mode))
+                plan = json.loads(await conn.fetchval('EXPLAIN (FORMAT JSON) EXECUTE plan_check({})'.format(
+                    ', '.join(literal(value) for value in samples[name])
+                )))[0]['Plan']
+                tables = sorted(set(seq_scans(plan)) - SMALL_TABLES)
+                print('{:<24} {:<20} {:>12.2f} {}'.format(
+                    name, mode, plan['Total Cost'], 'Seq Scan on ' + ', '.join(tables) if tables else 'ok'
+                ))
+                failures += bool(tables)
+            await conn.execute('DEALLOCATE plan_check')
+    finally:
+        await conn.close()
+    return failures
+
+
+async def run(args, dsn):
+    from main import migrate
+
+    os.chdir(ROOT)
+    migrate(dsn)
+    max_client, max_card = await seed(dsn, args.clients, args.cards_per_client)
+    return await check(dsn, max_client, max_card)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', help='existing database to use instead of a temporary PostgreSQL')
+    parser.add_argument('--clients', type=int, default=20000)
+    parser.add_argument('--cards-per-client', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.dsn:
+        failures = asyncio.run(run(args, args.dsn))
+    else:
+        with LocalPostgres() as dsn:
+            failures = asyncio.run(run(args, dsn))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
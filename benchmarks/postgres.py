@@ -0,0 +1,92 @@
+"""
+Временный экземпляр PostgreSQL для бенчмарков и наполнение его данными.
+
+Исполняемые файлы PostgreSQL ищутся в каталоге PG_BIN, в PATH и в /usr/lib/postgresql/*/bin.
+Под root сервер запускается от имени системного пользователя postgres.
+"""
+import asyncpg
+import glob
+import os
+import pwd
+import shutil
+import socket
+import subprocess
+import tempfile
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def find_bindir():
+    candidates = [os.environ.get('PG_BIN')] + os.environ.get('PATH', '').split(os.pathsep)
+    candidates += sorted(glob.glob('/usr/lib/postgresql/*/bin'), reverse=True)
+    for candidate in candidates:
+        if candidate and os.path.isfile(os.path.join(candidate, 'initdb')):
+            return candidate
+    raise RuntimeError('PostgreSQL binaries are not found. Set PG_BIN or pass an existing database DSN.')
+
+
+class LocalPostgres:
+    def __init__(self, database='sb_rest_bench'):
+        self.__bindir = find_bindir()
+        self.__database = database
+        self.__port = free_port()
+        self.__root = None
+        self.__user = None
+        if os.geteuid() == 0:
+            try:
+                self.__user = pwd.getpwnam('postgres')
+            except KeyError:
+                raise RuntimeError('PostgreSQL cannot run as root and there is no postgres system user.')
+
+    def __run(self, name, *args):
+        def demote():
+            os.setgid(self.__user.pw_gid)
+            os.setuid(self.__user.pw_uid)
+
+        subprocess.run(
+            [os.path.join(self.__bindir, name)] + list(args),
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            preexec_fn=demote if self.__user is not None else None
+        )
+
+    def __enter__(self):
+        self.__root = tempfile.mkdtemp(prefix='sb_rest_pg_')
+        if self.__user is not None:
+            os.chown(self.__root, self.__user.pw_uid, self.__user.pw_gid)
+        data = os.path.join(self.__root, 'data')
+        self.__run('initdb', '-D', data, '-U', 'postgres', '--auth=trust', '--encoding=UTF8')
+        self.__run(
+            'pg_ctl', '-D', data, '-l', os.path.join(self.__root, 'postgres.log'), '-w', 'start',
+            '-o', "-p {} -c listen_addresses=127.0.0.1 -c unix_socket_directories='{}' -c fsync=off".format(
+                self.__port, self.__root
+            )
+        )
+        self.__run('createdb', '-h', '127.0.0.1', '-p', str(self.__port), '-U', 'postgres', self.__database)
+        return 'postgresql://postgres@127.0.0.1:{}/{}'.format(self.__port, self.__database)
+
+    def __exit__(self, *_):
+        self.__run('pg_ctl', '-D', os.path.join(self.__root, 'data'), '-m', 'immediate', 'stop')
+        shutil.rmtree(self.__root, ignore_errors=True)
+
+
+async def seed(dsn, clients, cards_per_client):
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.execute(
+            "INSERT INTO clients(name) SELECT 'Клиент ' || i FROM generate_series(1, $1) AS i", clients
+        )
+        await conn.execute(
+            "INSERT INTO cards(owner_id, payment_system, currency, balance)"
+            " SELECT c.id, (ARRAY['Visa', 'MasterCard', 'Мир'])[1 + (c.id + s) % 3],"
+            " (ARRAY['RUB', 'USD', 'EUR'])[1 + s % 3], round((random() * 100000)::numeric, 2)"
+            " FROM clients c CROSS JOIN generate_series(1, $1) AS s",
+            cards_per_client
+        )
+        await conn.execute('ANALYZE')
+        return await conn.fetchval('SELECT MAX(id) FROM clients'), await conn.fetchval('SELECT MAX(id) FROM cards')
+    finally:
+        await conn.close()
@@ -0,0 +1,73 @@
+"""
+Сравнение пропускной способности кодировщиков protocol.py с прежними (dataclasses.asdict и dicttoxml).
+
+Запуск: python benchmarks/serializers.py
+"""
+import dataclasses
+import dicttoxml
+import json
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import model  # noqa: E402
+import protocol  # noqa: E402
+
+REPEATS = 5
+
+
+class LegacyXMLEncoder:
+    def __to_dict(self, o):
+        if isinstance(o, list):
+            return list(map(lambda x: self.__to_dict(x), o))
+        if dataclasses.is_dataclass(o):
+            return dataclasses.asdict(o)
+        return dict(o)
+
+    def encode(self, data):
+        return dicttoxml.dicttoxml(obj=self.__to_dict(data), attr_type=False)
+
+
+class LegacyJsonEncoder:
+    class EnhancedJsonEncoder(json.JSONEncoder):
+        def default(self, o):
+            if dataclasses.is_dataclass(o):
+                return dataclasses.asdict(o)
+            if isinstance(o, frozenset):
+                return list(o)
+            return super().default(o)
+
+    def encode(self, data):
+        return json.dumps(data, cls=self.EnhancedJsonEncoder)
+
+
+def payloads():
+    cards = [model.Card(id=i, owner_id=i % 100, payment_system='Visa', currency='RUB', balance=i * 1.5) for i in range(10000)]
+    clients = [
+        model.Client(id=i, name='Клиент {}'.format(i), cards=cards[i * 10:(i + 1) * 10]) for i in range(1000)
+    ]
+    return {'10000 cards': cards, '1000 clients x 10 cards': clients}
+
+
+def main():
+    logging.disable(logging.INFO)
+    encoders = [
+        ('json', LegacyJsonEncoder(), protocol.JsonEncoder()),
+        ('xml', LegacyXMLEncoder(), protocol.XMLEncoder()),
+    ]
+    print('json backend: {}'.format('orjson' if protocol.orjson is not None else 'json'))
+    print('{:<26} {:<6} {:>12} {:>12} {:>8}'.format('payload', 'format', 'legacy, ms', 'new, ms', 'speedup'))
+    for name, data in payloads().items():
+        for content, legacy, current in encoders:
+            legacy_ms = min(timeit.repeat(lambda: legacy.encode(data), number=1, repeat=REPEATS)) * 1000
+            current_ms = min(timeit.repeat(lambda: current.encode(data), number=1, repeat=REPEATS)) * 1000
+            print('{:<26} {:<6} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(
+                name, content, legacy_ms, current_ms, legacy_ms / current_ms
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import time
+
+from collections import OrderedDict
+from prometheus_client import Counter, Gauge
+
+HITS = Counter('response_cache_hits_total', 'Response cache hits', ['endpoint'])
+MISSES = Counter('response_cache_misses_total', 'Response cache misses', ['endpoint'])
+EVICTIONS = Counter('response_cache_evictions_total', 'Response cache evictions', ['reason'])
+ENTRIES = Gauge('response_cache_entries', 'Response cache entries', multiprocess_mode='livesum')
+BYTES = Gauge('response_cache_bytes', 'Response cache body bytes, compressed variants included', multiprocess_mode='livesum')
+
+
+class CachedResponse:
+    def __init__(self, content_type, body, headers):
+        self.content_type = content_type
+        self.body = body
+        self.headers = headers
+        # Сжатые варианты тела по кодированию, создаются при первом запросе с этим Accept-Encoding.
+        self.compressed = {}
+        # Байты тела и готовых сжатых вариантов, ключ записи в кэше (None, если ответ не закэширован).
+        self.size = len(body)
+        self.key = None
+
+
+class ResponseCache:
+    """
+    LRU-кэш закодированных ответов с ограничением по времени жизни.
+
+    Ключ записи — кортеж, первый элемент которого — имя обработчика. Каждая запись помечается тегами,
+    по которым её сбрасывают операции записи. Ответ, вычисленный во время сброса, в кэш не попадает.
+    Кэш ограничен числом записей (capacity) и суммарным размером тел со сжатыми вариантами (max_bytes).
+    Ответ больше max_bytes / MAX_ENTRY_SHARE не кэшируется: одна страница с большим limit не вытесняет весь кэш.
+    """
+    MAX_ENTRY_SHARE = 8
+
+    def __init__(self, capacity, ttl, max_bytes):
+        self.__capacity = capacity
+        self.__ttl = ttl
+        self.__max_bytes = max_bytes
+        self.__bytes = 0
+        self.__entries = OrderedDict()
+        self.__tags = {}
+        self.__generation = 0
+
+    @property
+    def generation(self):
+        return self.__generation
+
+    def get(self, key):
+        item = self.__entries.get(key)
+        if item is not None and item[1] <= time.monotonic():
+            self.__remove(key, 'expired')
+            item = None
+        if item is None:
+            MISSES.labels(key[0]).inc()
+            return None
+        self.__entries.move_to_end(key)
+        HITS.labels(key[0]).inc()
+        return item[0]
+
+    def put(self, key, entry, tags, generation):
+        if self.__capacity <= 0 or generation != self.__generation:
+            return
+        if key in self.__entries:
+            self.__remove(key, 'replaced')
+        if entry.size * self.MAX_ENTRY_SHARE > self.__max_bytes:
+            EVICTIONS.labels('too_large').inc()
+            return
+        entry.key = key
+        self.__entries[key] = (entry, time.monotonic() + self.__ttl, tags)
+        self.__bytes += entry.size
+        for tag in tags:
+            self.__tags.setdefault(tag, set()).add(key)
+        self.__shrink()
+        ENTRIES.set(len(self.__entries))
+
+    def grow(self, entry, size):
+        """Учесть готовый сжатый вариант тела entry размером size байт."""
+        entry.size += size
+        item = self.__entries.get(entry.key)
+        if item is not None and item[0] is entry:
+            self.__bytes += size
+            self.__shrink()
+
+    def __shrink(self):
+        while len(self.__entries) > self.__capacity or self.__bytes > self.__max_bytes:
+            self.__remove(next(iter(self.__entries)), 'capacity')
+        BYTES.set(self.__bytes)
+
+    def invalidate(self, *tags):
+        self.__generation += 1
+        for tag in tags:
+            for key in list(self.__tags.get(tag, ())):
+                self.__remove(key, 'invalidated')
+
+    def clear(self):
+        self.__generation += 1
+        for key in list(self.__entries):
+            self.__remove(key, 'invalidated')
+
+    def __remove(self, key, reason):
+        entry, _, tags = self.__entries.pop(key)
+        self.__bytes -= entry.size
+        BYTES.set(self.__bytes)
+        for tag in tags:
+            keys = self.__tags.get(tag)
+            keys.discard(key)
+            if not keys:
+                del self.__tags[tag]
+        EVICTIONS.labels(reason).inc()
+        ENTRIES.set(len(self.__entries))
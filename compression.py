@@ -0,0 +1,67 @@
+import asyncio
+import concurrent.futures
+import metrics
+import profiling
+import time
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class Compressor:
+    """
+    Сжатие тел ответов по Accept-Encoding.
+
+    Поддерживаются gzip и deflate, а если установлен пакет brotli — и br. Тела короче min_size отправляются как есть:
+    выигрыш от сжатия меньше заголовков и затрат на него. Сжатие выполняется в пуле потоков, zlib и brotli освобождают
+    GIL, поэтому цикл событий не блокируется на больших ответах.
+    """
+    GZIP_LEVEL = 6
+    BROTLI_QUALITY = 5
+    # При равном весе в Accept-Encoding выбирается кодирование, которое раньше в списке.
+    CODINGS = ('br', 'gzip', 'deflate') if brotli is not None else ('gzip', 'deflate')
+
+    def __init__(self, min_size, threads):
+        self.__min_size = min_size
+        self.__executor = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix='compress')
+
+    def negotiate(self, accept_encoding, size):
+        if not accept_encoding or size < self.__min_size:
+            return None
+        weights = {}
+        for part in accept_encoding.split(','):
+            coding, _, params = part.partition(';')
+            weight = 1.0
+            for param in params.split(';'):
+                name, _, value = param.strip().partition('=')
+                if name == 'q':
+                    try:
+                        weight = float(value)
+                    except ValueError:
+                        weight = 0.0
+            weights[coding.strip().lower()] = weight
+        best, best_weight = None, 0.0
+        for coding in self.CODINGS:
+            weight = weights.get(coding, weights.get('*', 0.0))
+            if weight > best_weight:
+                best, best_weight = coding, weight
+        return best
+
+    async def compress(self, coding, body):
+        started = time.perf_counter()
+        compressed = await asyncio.get_event_loop().run_in_executor(self.__executor, self.__compress, coding, body)
+        elapsed = time.perf_counter() - started
+        metrics.COMPRESS_LATENCY.labels(coding).observe(elapsed)
+        profiling.record('compress:' + coding, elapsed)
+        metrics.COMPRESS_RATIO.labels(coding).observe(len(compressed) / len(body))
+        return compressed
+
+    def __compress(self, coding, body):
+        if coding == 'br':
+            return brotli.compress(body, quality=self.BROTLI_QUALITY)
+        # wbits 31 — формат gzip, 15 — zlib, который в HTTP называется deflate.
+        compressor = zlib.compressobj(self.GZIP_LEVEL, zlib.DEFLATED, 31 if coding == 'gzip' else 15)
+        return compressor.compress(body) + compressor.flush()
@@ -0,0 +1,63 @@
+import time
+
+
+class CountTotal:
+    """Точный подсчёт через COUNT(*) на каждый запрос."""
+
+    async def total(self, conn, table):
+        return await conn.fetchval('SELECT COUNT(*) FROM {}'.format(table))
+
+
+class TriggerTotal:
+    """Точный счётчик из таблицы row_counts, которую поддерживают триггеры (миграция 0004)."""
+
+    async def total(self, conn, table):
+        return await conn.fetchval('SELECT total FROM row_counts WHERE table_name = $1', table)
+
+
+class EstimateTotal:
+    """
+    Оценка планировщика из pg_class.reltuples. Для ещё не проанализированной таблицы выполняется COUNT(*).
+
+    До PostgreSQL 14 такая таблица имеет reltuples = 0, а не -1, поэтому признаком служит и relpages = 0.
+    Пустая таблица считается COUNT(*) так же быстро.
+    """
+
+    def __init__(self):
+        self.__fallback = CountTotal()
+
+    async def total(self, conn, table):
+        stats = await conn.fetchrow('SELECT reltuples::bigint, relpages FROM pg_class WHERE oid = $1::regclass', table)
+        if stats is None or stats['reltuples'] < 0 or stats['relpages'] == 0:
+            return await self.__fallback.total(conn, table)
+        return stats['reltuples']
+
+
+class CachedTotal:
+    """Хранит результат другой стратегии в памяти процесса в течение ttl секунд."""
+
+    def __init__(self, origin, ttl):
+        self.__origin = origin
+        self.__ttl = ttl
+        self.__values = {}
+
+    async def total(self, conn, table):
+        now = time.monotonic()
+        cached = self.__values.get(table)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        value = await self.__origin.total(conn, table)
+        self.__values[table] = (value, now + self.__ttl)
+        return value
+
+
+def create_counter(strategy, ttl):
+    if strategy == 'count':
+        return CountTotal()
+    if strategy == 'exact':
+        return TriggerTotal()
+    if strategy == 'estimate':
+        return EstimateTotal()
+    if strategy == 'cached':
+        return CachedTotal(CountTotal(), ttl)
+    raise ValueError('Unknown total count strategy: {}'.format(strategy))
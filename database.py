@@ -1,118 +1,469 @@
+import asyncio
+import asyncpg
+import collections
+import contextlib
+import contextvars
+import dataclasses
+import json
+import logging
+import metrics
 import model
+import profiling
+import time
+
+# Столбцы выбираются явно, в порядке полей типов model: строки отображаются в объекты по позиции (RowMapper).
+CARD_COLUMNS = "id, owner_id, payment_system, currency, balance"
+CLIENTS_WITH_CARDS = (
+    "SELECT cl.id, cl.name, COALESCE(cc.cards, '[]') AS cards"
+    " FROM (SELECT id, name FROM clients {}) cl"
+    " LEFT JOIN LATERAL ("
+    "  SELECT json_agg(json_build_array(c.id, c.owner_id, c.payment_system, c.currency, c.balance) ORDER BY c.id) AS cards"
+    "  FROM cards c WHERE c.owner_id = cl.id"
+    " ) cc ON true"
+    " ORDER BY cl.id"
+)
+
+# Запросы с постоянным текстом. Каждое соединение пула подготавливает их один раз при создании.
+STATEMENTS = {
+    'all_cards': "SELECT " + CARD_COLUMNS + " FROM cards ORDER BY id OFFSET $1 LIMIT $2",
+    'all_cards_after': "SELECT " + CARD_COLUMNS + " FROM cards WHERE id > $1 ORDER BY id LIMIT $2",
+    'all_cards_by_client_id': "SELECT " + CARD_COLUMNS + " FROM cards WHERE owner_id = $1 ORDER BY id",
+    'all_cards_by_owner_ids': "SELECT " + CARD_COLUMNS + " FROM cards WHERE owner_id = ANY($1::int[]) ORDER BY owner_id, id",
+    'add_card': (
+        "INSERT INTO cards(owner_id, payment_system, currency, balance) VALUES($1, $2, $3, $4)"
+        " RETURNING " + CARD_COLUMNS + ", version"
+    ),
+    # Условие ANY позволяет найти владельцев по первичному ключу, а не сканировать clients целиком.
+    'add_cards': (
+        "INSERT INTO cards(owner_id, payment_system, currency, balance)"
+        " SELECT t.owner_id, t.payment_system, t.currency, t.balance"
+        " FROM unnest($1::bigint[], $2::text[], $3::text[], $4::numeric[])"
+        " WITH ORDINALITY AS t(owner_id, payment_system, currency, balance, ord)"
+        " JOIN clients cl ON cl.id = t.owner_id AND cl.id = ANY($1::bigint[])"
+        " ORDER BY t.ord RETURNING " + CARD_COLUMNS
+    ),
+    'change_card': (
+        "UPDATE cards SET owner_id = COALESCE($2, cards.owner_id), payment_system = COALESCE($3, cards.payment_system),"
+        " currency = COALESCE($4, cards.currency), balance = COALESCE($5, cards.balance), version = cards.version + 1"
+        " FROM (SELECT id, owner_id, version FROM cards WHERE id = $1) previous"
+        " WHERE cards.id = previous.id AND cards.version = previous.version"
+        " AND ($6::int[] IS NULL OR previous.version = ANY($6::int[]))"
+        " RETURNING cards.id, cards.owner_id, cards.payment_system, cards.currency, cards.balance, cards.version,"
+        " previous.owner_id AS previous_owner_id"
+    ),
+    'card_version': "SELECT version FROM cards WHERE id = $1",
+    'all_clients': CLIENTS_WITH_CARDS.format('ORDER BY id OFFSET $1 LIMIT $2'),
+    'all_clients_after': CLIENTS_WITH_CARDS.format('WHERE id > $1 ORDER BY id LIMIT $2'),
+    'client_by_id': "SELECT id, name FROM clients WHERE id = $1",
+    'client_balances': (
+        "SELECT cl.id, cl.name, b.currency, b.balance FROM clients cl"
+        " LEFT JOIN client_balances b ON b.client_id = cl.id AND b.cards > 0"
+        " WHERE cl.id = ANY($1::int[]) ORDER BY cl.id, b.currency"
+    ),
+    # Валидаторы условных GET (миграция 0010): версия таблицы и сумма версий строк client_balances клиента.
+    'table_versions': "SELECT table_name, version FROM row_counts WHERE table_name = ANY($1::text[])",
+    'balance_versions': (
+        "SELECT cl.id, COALESCE(SUM(b.version), 0)::bigint AS version FROM clients cl"
+        " LEFT JOIN client_balances b ON b.client_id = cl.id"
+        " WHERE cl.id = ANY($1::int[]) GROUP BY cl.id"
+    ),
+    'add_clients': (
+        "INSERT INTO clients(name) SELECT t.name FROM unnest($1::text[]) WITH ORDINALITY AS t(name, ord)"
+        " ORDER BY t.ord RETURNING id, name"
+    ),
+    'add_client': "INSERT INTO clients(name) VALUES($1) RETURNING id, name",
+}
+
+# Выгрузки через COPY: строки уходят клиенту в том виде, в каком их отдаёт сервер, без объектов в Python.
+EXPORTS = {
+    'export_cards': (
+        "SELECT id, owner_id, payment_system, currency, balance FROM cards"
+        " WHERE ($1::bigint[] IS NULL OR owner_id = ANY($1::bigint[])) AND ($2::text[] IS NULL OR currency = ANY($2::text[]))"
+        " AND ($3::text[] IS NULL OR payment_system = ANY($3::text[])) ORDER BY id"
+    ),
+    'export_clients': "SELECT id, name FROM clients ORDER BY id",
+}
+# Формат csv, в отличие от text, не экранирует обратную косую черту. Кавычка и разделитель — управляющие символы,
+# которые row_to_json всегда экранирует, поэтому каждая строка вывода — JSON-документ без изменений.
+NDJSON_COPY = {'format': 'csv', 'quote': '\x01', 'delimiter': '\x02'}
+CSV_COPY = {'format': 'csv', 'header': True}
+
+logger = logging.getLogger(__name__)
+# Ложь, если закрытый метод asyncpg недоступен: запросы подготавливаются при первом выполнении.
+eager_prepare = True
+
+
+async def prepare_statements(conn):
+    global eager_prepare
+    # NUMERIC читается сразу в float текстовым кодеком, без Decimal и преобразования каждой строки в Python.
+    # Кодек задаётся до подготовки запросов: asyncpg сбрасывает кэш запросов при смене кодеков.
+    await conn.set_type_codec('numeric', encoder=str, decoder=float, schema='pg_catalog', format='text')
+    # Запросы попадают в кэш подготовленных запросов asyncpg, поэтому fetch/cursor с тем же текстом
+    # выполняются без Parse. При изменении схемы asyncpg сам подготавливает устаревший запрос заново.
+    # Connection._get_statement — закрытый метод asyncpg: если его нет или сигнатура другая, сервис запускается
+    # без предварительной подготовки, а не падает в init каждого соединения пула.
+    if eager_prepare:
+        try:
+            for query in STATEMENTS.values():
+                await conn._get_statement(query, None)
+        except (AttributeError, TypeError) as e:
+            eager_prepare = False
+            logger.warning('Statements are prepared lazily, asyncpg %s: %s', asyncpg.__version__, e)
+    # Подготовка оставляет открытой неявную транзакцию с блокировками таблиц до следующего запроса. Без этого
+    # простаивающие соединения пула блокируют DDL (например, ALTER TABLE в миграциях других экземпляров).
+    await conn.execute('SELECT 1')
+
+
+def create_pool(dsn, **kwargs):
+    # Без ограничения времени жизни подготовленные при открытии соединения запросы не вытесняются из кэша.
+    return asyncpg.create_pool(dsn=dsn, init=prepare_statements, max_cached_statement_lifetime=0, **kwargs)
+
+
+class RowMapper:
+    """
+    Отображение строк запроса в объекты типа data_type по позиции столбцов.
+
+    Функция построения генерируется один раз по списку полей. Она заполняет слоты напрямую и минует __setattr__
+    замороженного датакласса, который в несколько раз медленнее. Столбцы после полей типа не читаются, поля после
+    последнего столбца берутся из tail.
+    """
+
+    def __init__(self, data_type, *tail):
+        fields = [f.name for f in dataclasses.fields(data_type)]
+        width = len(fields) - len(tail)
+        namespace = {'new': object.__new__, 'data_type': data_type, 'tail': tail}
+        namespace.update({'set_' + name: getattr(data_type, name).__set__ for name in fields})
+        exec(
+            'def one(r):\n    o = new(data_type)\n' + ''.join(
+                '    set_{}(o, r[{}])\n'.format(name, i) if i < width else
+                '    set_{}(o, tail[{}])\n'.format(name, i - width)
+                for i, name in enumerate(fields)
+            ) + '    return o\n',
+            namespace
+        )
+        self.data_type = data_type
+        self.width = width
+        self.one = namespace['one']
+
+    def many(self, records):
+        one = self.one
+        return [one(record) for record in records]
+
+    def columns(self, records):
+        columns = tuple(zip(*records))[:self.width] or ((),) * self.width
+        return model.Columns(self.data_type, columns)
+
+
+CARD_MAPPER = RowMapper(model.Card)
+CLIENT_MAPPER = RowMapper(model.Client)
+# Клиент из запроса без столбца карт.
+CLIENT_WITHOUT_CARDS_MAPPER = RowMapper(model.Client, frozenset())
+
+
+# Источник чтения текущего запроса. Задача каждого запроса aiohttp получает свою копию контекста.
+READ_SCOPE = contextvars.ContextVar('read_scope', default=None)
+
+
+class ReadScope:
+    def __init__(self, replica):
+        self.replica = replica
+        # Клиент (None — общие данные) -> пул, из которого он уже читался в этом запросе.
+        self.sources = {}
 
 
 class Database:
+    """
+    Запросы к базе через пул основного сервера (transactor) и, если заданы, пулы реплик.
+
+    Запись всегда идёт в основной сервер. Чтение списков, клиентов, балансов и выгрузки идёт в реплику,
+    выбранную по очереди (round_robin) или по наименьшему числу занятых соединений (least_busy). Реплика
+    выбирается один раз на запрос (begin_read): версии для ETag и сами данные читаются из одной реплики, и тело
+    ответа не бывает старше своего ETag. Реплика отстаёт от основного сервера, поэтому клиент, данные которого
+    изменены за последние staleness секунд (этим процессом или, по потоку изменений, другим — mark_written),
+    до конца запроса читается из основного сервера: изменивший карту сразу видит её в балансе и списке карт.
+    """
+    STREAM_PREFETCH = 1000
+    REPLICA_SELECTIONS = ('round_robin', 'least_busy')
 
-    def __init__(self, transactor):
+    def __init__(
+        self, transactor, counter, cursor_threshold=1000, acquire_timeout=None,
+        replicas=(), replica_selection='round_robin', staleness=0.0
+    ):
+        if replica_selection not in self.REPLICA_SELECTIONS:
+            raise ValueError('Unknown replica selection: {}'.format(replica_selection))
         self.__transactor = transactor
+        self.__primary = ('primary', transactor)
+        self.__counter = counter
+        self.__cursor_threshold = cursor_threshold
+        self.__acquire_timeout = acquire_timeout
+        self.__replicas = [('replica{}'.format(i), pool) for i, pool in enumerate(replicas)]
+        self.__replica_selection = replica_selection
+        self.__next_replica = 0
+        self.__staleness = staleness
+        # Клиент -> момент (time.monotonic), до которого его данные читаются из основного сервера.
+        self.__written = collections.OrderedDict()
+        # Момент, до которого основной сервер читают все: изменения неизвестны после разрыва потока изменений.
+        self.__all_written_until = 0.0
 
-    async def all_cards(self, offset, limit):
-        result = []
-        async with self.__transactor.acquire() as conn:
-            async with conn.transaction():
-                async for record in conn.cursor('SELECT * FROM cards OFFSET $1 LIMIT $2', offset, limit):
-                    result.append(model.Card(
-                        id=record['id'],
-                        owner_id=record['owner_id'],
-                        payment_system=record['payment_system'],
-                        currency=record['currency'],
-                        balance=float(record['balance'])
-                    ))
-                count = await conn.fetchval('SELECT COUNT(*) FROM cards')
-        return result, count
+    @contextlib.asynccontextmanager
+    async def __acquire(self, name='primary', pool=None):
+        if pool is None:
+            pool = self.__transactor
+        started = time.perf_counter()
+        try:
+            conn = await pool.acquire(timeout=self.__acquire_timeout)
+        except asyncio.TimeoutError:
+            metrics.POOL_TIMEOUTS.labels(name).inc()
+            raise model.OverloadedException('Нет свободного соединения с базой')
+        try:
+            waited = time.perf_counter() - started
+            metrics.POOL_ACQUIRE.labels(name).observe(waited)
+            profiling.record('pool:' + name, waited)
+            metrics.observe_pool(name, pool)
+            yield conn
+        finally:
+            await pool.release(conn)
 
-    async def all_cards_by_client_id(self, client_id):
+    def begin_read(self):
+        if self.__replicas:
+            READ_SCOPE.set(ReadScope(self.__replica()))
+
+    def read_source(self, client_id=None):
+        """Пул (имя, пул), из которого текущий запрос читает данные клиента client_id или общие данные."""
+        if not self.__replicas:
+            return self.__primary
+        scope = READ_SCOPE.get()
+        if scope is None:
+            # Чтение вне запроса: реплика выбирается на каждое обращение.
+            scope = ReadScope(self.__replica())
+        source = scope.sources.get(client_id)
+        if source is None:
+            # Выбор запоминается до конца запроса: если окно staleness истечёт или начнётся посреди запроса,
+            # версия и данные всё равно читаются из одного пула.
+            source = self.__primary if self.__written_recently(client_id) else scope.replica
+            scope.sources[client_id] = source
+        return source
+
+    def __acquire_read(self, client_ids=(), source=None):
+        if source is None:
+            sources = {self.read_source(client_id) for client_id in client_ids} or {self.read_source()}
+            source = self.__primary if self.__primary in sources else sources.pop()
+        return self.__acquire(*source)
+
+    def __replica(self):
+        start = self.__next_replica
+        self.__next_replica = (start + 1) % len(self.__replicas)
+        if self.__replica_selection == 'least_busy':
+            # При равной загрузке выбирается следующая по очереди реплика.
+            candidates = self.__replicas[start:] + self.__replicas[:start]
+            return min(candidates, key=lambda replica: replica[1].get_size() - replica[1].get_idle_size())
+        return self.__replicas[start]
+
+    def __written_recently(self, client_id):
+        now = time.monotonic()
+        return self.__all_written_until > now or self.__written.get(client_id, 0) > now
+
+    def mark_written(self, client_ids):
+        """Читать клиентов client_ids из основного сервера следующие staleness секунд; None — всех клиентов."""
+        if not self.__replicas or self.__staleness <= 0:
+            return
+        now = time.monotonic()
+        if client_ids is None:
+            self.__all_written_until = now + self.__staleness
+            return
+        # Записи упорядочены по сроку, истёкшие удаляются с начала.
+        while self.__written and next(iter(self.__written.values())) <= now:
+            self.__written.popitem(last=False)
+        for client_id in client_ids:
+            self.__written.pop(client_id, None)
+            self.__written[client_id] = now + self.__staleness
+
+    async def __total(self, conn, table):
+        with metrics.query_timer('total_' + table):
+            return await self.__counter.total(conn, table)
+
+    @staticmethod
+    async def __fetch(conn, name, *args):
+        with metrics.query_timer(name):
+            return await conn.fetch(STATEMENTS[name], *args)
+
+    @staticmethod
+    async def __fetchrow(conn, name, *args):
+        with metrics.query_timer(name):
+            return await conn.fetchrow(STATEMENTS[name], *args)
+
+    async def __page(self, conn, name, limit, *args):
+        if limit <= self.__cursor_threshold:
+            return await self.__fetch(conn, name, *args)
         result = []
-        async with self.__transactor.acquire() as conn:
+        with metrics.query_timer(name):
             async with conn.transaction():
-                async for record in conn.cursor('SELECT * FROM cards WHERE owner_id = $1', client_id):
-                    result.append(model.Card(
-                        id=record['id'],
-                        owner_id=record['owner_id'],
-                        payment_system=record['payment_system'],
-                        currency=record['currency'],
-                        balance=float(record['balance'])
-                    ))
+                async for record in conn.cursor(STATEMENTS[name], *args, prefetch=self.STREAM_PREFETCH):
+                    result.append(record)
         return result
 
-    async def all_cards_by_owner_ids(self, ids):
-        result = []
-        async with self.__transactor.acquire() as conn:
+    @staticmethod
+    def __client_cards(cards):
+        # Карты клиента приходят JSON-массивом, NUMERIC в нём может прийти целым числом.
+        return [CARD_MAPPER.one((c[0], c[1], c[2], c[3], float(c[4]))) for c in json.loads(cards)]
+
+    def __cards_page(self, records, limit):
+        return CARD_MAPPER.columns(records) if limit > self.__cursor_threshold else CARD_MAPPER.many(records)
+
+    def __clients_page(self, records, limit):
+        if limit > self.__cursor_threshold:
+            ids, names, cards = tuple(zip(*records)) or ((), (), ())
+            return model.Columns(model.Client, (ids, names, [self.__client_cards(c) for c in cards]))
+        return [CLIENT_MAPPER.one((record[0], record[1], self.__client_cards(record[2]))) for record in records]
+
+    async def all_cards(self, offset, limit, total=True):
+        async with self.__acquire_read() as conn:
+            records = await self.__page(conn, 'all_cards', limit, offset, limit)
+            count = await self.__total(conn, 'cards') if total else None
+        return self.__cards_page(records, limit), count
+
+    async def all_cards_after(self, after, limit, total=True):
+        async with self.__acquire_read() as conn:
+            records = await self.__page(conn, 'all_cards_after', limit, after, limit)
+            count = await self.__total(conn, 'cards') if total else None
+        return self.__cards_page(records, limit), count
+
+    async def iter_cards(self, offset, limit, after=None):
+        async with self.__acquire_read() as conn:
             async with conn.transaction():
-                async for record in conn.cursor('SELECT * FROM cards WHERE owner_id = ANY($1::int[])', ids):
-                    result.append(model.Card(
-                        id=record['id'],
-                        owner_id=record['owner_id'],
-                        payment_system=record['payment_system'],
-                        currency=record['currency'],
-                        balance=float(record['balance'])
-                    ))
-        return result
+                if after is not None:
+                    records = conn.cursor(STATEMENTS['all_cards_after'], after, limit, prefetch=self.STREAM_PREFETCH)
+                else:
+                    records = conn.cursor(STATEMENTS['all_cards'], offset, limit, prefetch=self.STREAM_PREFETCH)
+                async for record in records:
+                    yield CARD_MAPPER.one(record)
+
+    async def all_cards_by_client_id(self, client_id):
+        async with self.__acquire_read((client_id,)) as conn:
+            records = await self.__fetch(conn, 'all_cards_by_client_id', client_id)
+        return CARD_MAPPER.many(records)
+
+    async def all_cards_by_owner_ids(self, ids, source=None):
+        async with self.__acquire_read(ids, source) as conn:
+            records = await self.__fetch(conn, 'all_cards_by_owner_ids', ids)
+        return CARD_MAPPER.many(records)
 
     async def add_card(self, owner_id: int, payment_system: str, currency: str, balance: float):
-        async with self.__transactor.acquire() as conn:
-            async with conn.transaction():
-                record = await conn.fetchrow(
-                    "INSERT INTO cards(owner_id, payment_system, currency, balance) VALUES($1, $2, $3, $4) RETURNING *",
-                    owner_id, payment_system, currency, balance
-                )
-                return model.Card(
-                    id=record['id'],
-                    owner_id=record['owner_id'],
-                    payment_system=record['payment_system'],
-                    currency=record['currency'],
-                    balance=float(record['balance'])
-                )
+        async with self.__acquire() as conn:
+            record = await self.__fetchrow(conn, 'add_card', owner_id, payment_system, currency, balance)
+        self.mark_written((owner_id,))
+        return CARD_MAPPER.one(record), record['version']
 
-    async def change_card(self, card_id, data):
-        changes = [''.join(x) for x in [{'{} = ${}'.format(v, i + 2)} for (i, v) in enumerate(data)]]
-        values = [card_id] + list(data.values())
-        async with self.__transactor.acquire() as conn:
-            async with conn.transaction():
-                record = await conn.fetchrow("UPDATE cards SET {} WHERE id = $1 RETURNING *".format(", ".join(changes)), *values)
+    async def add_cards(self, rows):
+        async with self.__acquire() as conn:
+            records = await self.__fetch(conn, 'add_cards', *[list(column) for column in zip(*rows)])
+        owners = {record['owner_id'] for record in records}
+        self.mark_written(owners)
+        created = iter(records)
+        return [CARD_MAPPER.one(next(created)) if row[0] in owners else None for row in rows]
+
+    async def change_card(self, card_id, data, versions=None):
+        # Возвращает (карта, прежний владелец, новая версия); (None, None, None), если карты нет,
+        # и (None, None, текущая версия), если текущая версия не входит в versions.
+        async with self.__acquire() as conn:
+            while True:
+                # Строка, изменённая параллельно после чтения previous, не обновляется, и запрос повторяется.
+                record = await self.__fetchrow(
+                    conn, 'change_card', card_id, data.get('owner_id'), data.get('payment_system'),
+                    data.get('currency'), data.get('balance'), versions
+                )
                 if record:
-                    return model.Card(
-                        id=record['id'],
-                        owner_id=record['owner_id'],
-                        payment_system=record['payment_system'],
-                        currency=record['currency'],
-                        balance=float(record['balance'])
-                    )
-                else:
-                    return None
+                    self.mark_written({record['owner_id'], record['previous_owner_id']})
+                    return CARD_MAPPER.one(record), record['previous_owner_id'], record['version']
+                version = await self.__fetchrow(conn, 'card_version', card_id)
+                if version is None:
+                    return None, None, None
+                if versions is not None and version['version'] not in versions:
+                    return None, None, version['version']
 
-    async def all_clients(self, offset, limit):
-        result = []
-        async with self.__transactor.acquire() as conn:
-            async with conn.transaction():
-                async for record in conn.cursor('SELECT * FROM clients OFFSET $1 LIMIT $2', offset, limit):
-                    result.append(model.Client(
-                        id=record['id'],
-                        name=record['name'],
-                        cards=frozenset()
-                    ))
-                count = await conn.fetchval('SELECT COUNT(*) FROM cards')
-        return result, count
+    async def export_cards(self, output, ndjson, owner_ids=None, currencies=None, payment_systems=None):
+        await self.__export(output, 'export_cards', ndjson, owner_ids, currencies, payment_systems)
 
-    async def client_by_id(self, client_id):
-        async with self.__transactor.acquire() as conn:
+    async def export_clients(self, output, ndjson):
+        await self.__export(output, 'export_clients', ndjson)
+
+    async def __export(self, output, name, ndjson, *args):
+        # COPY не принимает параметры, asyncpg подставляет их в текст запроса как литералы.
+        if ndjson:
+            query, options = 'SELECT row_to_json(t) FROM ({}) t'.format(EXPORTS[name]), NDJSON_COPY
+        else:
+            query, options = EXPORTS[name], CSV_COPY
+        async with self.__acquire_read() as conn:
+            with metrics.query_timer(name):
+                await conn.copy_from_query(query, *args, output=output, **options)
+
+    async def all_clients(self, offset, limit, total=True):
+        async with self.__acquire_read() as conn:
+            records = await self.__page(conn, 'all_clients', limit, offset, limit)
+            count = await self.__total(conn, 'clients') if total else None
+        return self.__clients_page(records, limit), count
+
+    async def all_clients_after(self, after, limit, total=True):
+        async with self.__acquire_read() as conn:
+            records = await self.__page(conn, 'all_clients_after', limit, after, limit)
+            count = await self.__total(conn, 'clients') if total else None
+        return self.__clients_page(records, limit), count
+
+    async def iter_clients(self, offset, limit, after=None):
+        async with self.__acquire_read() as conn:
             async with conn.transaction():
-                record = await conn.fetchrow("SELECT * FROM clients WHERE id = $1", client_id)
-                if record:
-                    return model.Client(
-                        id=record['id'],
-                        name=record['name'],
-                        cards=frozenset()
-                    )
+                if after is not None:
+                    records = conn.cursor(STATEMENTS['all_clients_after'], after, limit, prefetch=self.STREAM_PREFETCH)
                 else:
-                    return None
+                    records = conn.cursor(STATEMENTS['all_clients'], offset, limit, prefetch=self.STREAM_PREFETCH)
+                async for record in records:
+                    yield CLIENT_MAPPER.one((record[0], record[1], self.__client_cards(record[2])))
+
+    async def client_by_id(self, client_id):
+        async with self.__acquire_read((client_id,)) as conn:
+            record = await self.__fetchrow(conn, 'client_by_id', client_id)
+        if record:
+            return CLIENT_WITHOUT_CARDS_MAPPER.one(record)
+        else:
+            return None
+
+    async def client_balances(self, ids, source=None):
+        async with self.__acquire_read(ids, source) as conn:
+            records = await self.__fetch(conn, 'client_balances', ids)
+        balances = {}
+        for record in records:
+            if record['id'] not in balances:
+                balances[record['id']] = (record['name'], {})
+            if record['currency'] is not None:
+                balances[record['id']][1][record['currency']] = record['balance']
+        return [
+            model.Balance(
+                id=client_id, name=balances[client_id][0], cards=[],
+                balance=sum(balances[client_id][1].values(), 0.0), currencies=balances[client_id][1]
+            ) if client_id in balances else None
+            for client_id in ids
+        ]
+
+    async def table_versions(self, tables, source=None):
+        async with self.__acquire_read(source=source) as conn:
+            records = await self.__fetch(conn, 'table_versions', tables)
+        versions = {record['table_name']: record['version'] for record in records}
+        return [versions.get(table) for table in tables]
+
+    async def balance_versions(self, ids, source=None):
+        async with self.__acquire_read(ids, source) as conn:
+            records = await self.__fetch(conn, 'balance_versions', ids)
+        versions = {record['id']: record['version'] for record in records}
+        return [versions.get(client_id) for client_id in ids]
+
+    async def add_clients(self, names):
+        async with self.__acquire() as conn:
+            records = await self.__fetch(conn, 'add_clients', names)
+        self.mark_written(record['id'] for record in records)
+        return CLIENT_WITHOUT_CARDS_MAPPER.many(records)
 
     async def add_client(self, name):
-        async with self.__transactor.acquire() as conn:
-            async with conn.transaction():
-                record = await conn.fetchrow("INSERT INTO clients(name) VALUES($1) RETURNING *", name)
-                return model.Client(
-                    id=record['id'],
-                    name=record['name'],
-                    cards=frozenset()
-                )
\ No newline at end of file
+        async with self.__acquire() as conn:
+            record = await self.__fetchrow(conn, 'add_client', name)
+        self.mark_written((record['id'],))
+        return CLIENT_WITHOUT_CARDS_MAPPER.one(record)
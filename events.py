@@ -0,0 +1,155 @@
+import asyncio
+import asyncpg
+import collections
+import json
+import logging
+import metrics
+
+from protocol import json_dumps
+
+
+class Subscription:
+    """Очередь готовых к отправке событий одного подписчика /v1/events."""
+
+    def __init__(self, tables, client_ids, limit):
+        self.tables = tables
+        self.client_ids = client_ids
+        self.overflowed = False
+        self.__limit = limit
+        self.__frames = collections.deque()
+        self.__wakeup = asyncio.Event()
+
+    def matches(self, event):
+        if self.tables and event.table not in self.tables:
+            return False
+        return not self.client_ids or bool(self.client_ids.intersection(event.client_ids))
+
+    def push(self, frame):
+        if len(self.__frames) >= self.__limit:
+            # Медленный подписчик отключается и продолжает поток с Last-Event-ID из кольцевого буфера.
+            self.overflowed = True
+        else:
+            self.__frames.append(frame)
+        self.__wakeup.set()
+
+    async def get(self, timeout):
+        if not self.__frames and not self.overflowed:
+            self.__wakeup.clear()
+            try:
+                await asyncio.wait_for(self.__wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self.__frames.popleft() if self.__frames and not self.overflowed else None
+
+
+class ChangeEvent:
+    def __init__(self, seq, table, client_ids, frame):
+        self.seq = seq
+        self.table = table
+        self.client_ids = client_ids
+        self.frame = frame
+
+
+class ChangeFeed:
+    """
+    Поток изменений cards и clients из канала change_feed (миграция 0009).
+
+    Уведомления принимает одно выделенное соединение, вне пула. Последние события хранятся в кольцевом буфере,
+    чтобы переподключившийся подписчик получил пропущенное. Если соединение с базой потеряно, события за время
+    переподключения неизвестны: буфер очищается, а подписчики получают событие reset.
+
+    on_change(table, client_ids) вызывается на каждое событие с таблицей и затронутыми клиентами и с (None, None),
+    когда изменения неизвестны, — так каждый процесс узнаёт о записях других процессов (ClientModel.changed).
+    """
+    CHANNEL = 'change_feed'
+    RECONNECT_DELAY = 1
+    SUBSCRIBER_LIMIT = 1000
+    RESET = b'event: reset\ndata: {}\n\n'
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, dsn, buffer_size, on_change=None):
+        self.__dsn = dsn
+        self.__on_change = on_change
+        self.__buffer = collections.deque(maxlen=buffer_size)
+        self.__subscriptions = set()
+        self.__task = None
+
+    async def start(self):
+        connected = asyncio.get_event_loop().create_future()
+        self.__task = asyncio.ensure_future(self.__listen(connected))
+        await connected
+
+    def subscribe(self, tables, client_ids, last_event_id=None):
+        subscription = Subscription(tables, client_ids, self.SUBSCRIBER_LIMIT)
+        if last_event_id is not None:
+            missed = self.__since(last_event_id)
+            if missed is None:
+                subscription.push(self.RESET)
+            else:
+                for event in missed:
+                    if subscription.matches(event):
+                        subscription.push(event.frame)
+        self.__subscriptions.add(subscription)
+        metrics.CHANGE_FEED_SUBSCRIBERS.inc()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.__subscriptions.discard(subscription)
+        metrics.CHANGE_FEED_SUBSCRIBERS.dec()
+        if subscription.overflowed:
+            metrics.CHANGE_FEED_DROPPED.inc()
+
+    def __since(self, last_event_id):
+        # События приходят в порядке фиксации транзакций, а не в порядке номеров, поэтому ищется позиция события.
+        events = list(self.__buffer)
+        for position, event in enumerate(events):
+            if event.seq == last_event_id:
+                return events[position + 1:]
+        return None
+
+    def __notify(self, connection, pid, channel, payload):
+        for data in json.loads(payload):
+            client_ids = tuple(x for x in (data['client_id'], data['previous_client_id']) if x is not None)
+            frame = b'id: %d\nevent: %s\ndata: %s\n\n' % (data['seq'], data['table'].encode(), json_dumps(data))
+            event = ChangeEvent(data['seq'], data['table'], client_ids, frame)
+            if self.__on_change is not None:
+                self.__on_change(event.table, client_ids)
+            self.__buffer.append(event)
+            metrics.CHANGE_FEED_EVENTS.labels(event.table).inc()
+            for subscription in self.__subscriptions:
+                if subscription.matches(event):
+                    subscription.push(event.frame)
+
+    def __reset(self):
+        if self.__on_change is not None:
+            self.__on_change(None, None)
+        self.__buffer.clear()
+        for subscription in self.__subscriptions:
+            subscription.push(self.RESET)
+
+    async def __listen(self, connected):
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(self.__dsn)
+                lost = asyncio.get_event_loop().create_future()
+                conn.add_termination_listener(lambda _: lost.done() or lost.set_result(None))
+                await conn.add_listener(self.CHANNEL, self.__notify)
+                if connected.done():
+                    self.__reset()
+                    self.logger.info('Change feed listener reconnected')
+                else:
+                    connected.set_result(None)
+                await lost
+                if self.__on_change is not None:
+                    self.__on_change(None, None)
+                self.logger.warning('Change feed listener connection lost')
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                if not connected.done():
+                    connected.set_exception(e)
+                    return
+                self.logger.warning('Change feed listener failed: %s', e)
+            finally:
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(self.RECONNECT_DELAY)
@@ -0,0 +1,80 @@
+import asyncio
+import metrics
+import profiling
+import time
+
+
+class BatchLoader:
+    """
+    Объединяет загрузки по ключу в пакеты.
+
+    Ключи, запрошенные в течение одного шага цикла событий (или окна window секунд), передаются одним вызовом
+    batch(keys), который возвращает значения в порядке ключей. Повторный запрос ключа, который уже ждёт пакета или
+    загружается, получает тот же результат без нового обращения к базе.
+
+    Если задана partition(key), ключи с разными значениями partition загружаются разными пакетами,
+    batch(keys, part) получает общее значение пакета (например, источник чтения, Database.read_source).
+    """
+
+    def __init__(self, name, batch, window=0.0, max_size=1000, partition=None):
+        self.__name = name
+        self.__batch = batch
+        self.__window = window
+        self.__max_size = max_size
+        self.__partition = partition
+        self.__queue = {}
+        self.__flights = {}
+        self.__handle = None
+
+    def load(self, key):
+        key = (self.__partition(key) if self.__partition is not None else None, key)
+        future = self.__queue.get(key) or self.__flights.get(key)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = loop.create_future()
+            self.__queue[key] = future
+            if len(self.__queue) >= self.__max_size:
+                self.__dispatch()
+            elif self.__handle is None:
+                self.__handle = loop.call_later(self.__window, self.__dispatch)
+        # Отмена одного ожидающего не должна отменять загрузку для остальных.
+        waiter = asyncio.shield(future)
+        if profiling.CURRENT_TRACE.get() is not None:
+            started = time.perf_counter()
+            waiter.add_done_callback(lambda _: profiling.record('load:' + self.__name, time.perf_counter() - started))
+        return waiter
+
+    def clear(self):
+        # Загрузки, начатые до записи, могут вернуть прежние данные, поэтому новые запросы к ним не присоединяются.
+        self.__flights.clear()
+
+    def __dispatch(self):
+        if self.__handle is not None:
+            self.__handle.cancel()
+            self.__handle = None
+        queue, self.__queue = self.__queue, {}
+        self.__flights.update(queue)
+        parts = {}
+        for key, future in queue.items():
+            parts.setdefault(key[0], {})[key] = future
+        for part, part_queue in parts.items():
+            asyncio.ensure_future(self.__run(part, part_queue))
+
+    async def __run(self, part, queue):
+        profiling.untraced()
+        metrics.LOADER_BATCH_SIZE.labels(self.__name).observe(len(queue))
+        keys = [key for (_, key) in queue]
+        try:
+            values = await (self.__batch(keys) if self.__partition is None else self.__batch(keys, part))
+            for future, value in zip(queue.values(), values):
+                future.set_result(value)
+        except Exception as e:
+            for future in queue.values():
+                if not future.done():
+                    future.set_exception(e)
+                    # Ошибка помечается полученной, даже если все ожидающие уже отменены.
+                    future.exception()
+        finally:
+            for key, future in queue.items():
+                if self.__flights.get(key) is future:
+                    del self.__flights[key]
@@ -0,0 +1,97 @@
+import contextlib
+import os
+import profiling
+import time
+
+from aiohttp import web
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, float('inf'))
+
+REQUESTS = Counter('http_requests_total', 'HTTP requests', ['method', 'route', 'status'])
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency', ['method', 'route', 'status'])
+RESPONSE_SIZE = Histogram(
+    'http_response_size_bytes', 'HTTP response body size', ['method', 'route', 'status'], buckets=SIZE_BUCKETS
+)
+QUERY_LATENCY = Histogram('db_query_duration_seconds', 'Database query latency', ['query'])
+POOL_ACQUIRE = Histogram('db_pool_acquire_seconds', 'Time spent waiting for a pool connection', ['pool'])
+POOL_SIZE = Gauge('db_pool_size', 'Open pool connections', ['pool'], multiprocess_mode='livesum')
+POOL_IDLE = Gauge('db_pool_idle', 'Idle pool connections', ['pool'], multiprocess_mode='livesum')
+ENCODE_LATENCY = Histogram('encoder_duration_seconds', 'Response encoding time', ['content_type'])
+POOL_TIMEOUTS = Counter('db_pool_acquire_timeouts_total', 'Pool connection waits that timed out', ['pool'])
+ADMISSION_IN_FLIGHT = Gauge('admission_in_flight', 'Requests being processed', multiprocess_mode='livesum')
+ADMISSION_QUEUE_DEPTH = Gauge('admission_queue_depth', 'Requests waiting for admission', multiprocess_mode='livesum')
+ADMISSION_QUEUED = Counter('admission_queued_total', 'Requests that waited for admission')
+ADMISSION_QUEUE_WAIT = Histogram('admission_queue_wait_seconds', 'Time spent waiting for admission')
+ADMISSION_REJECTED = Counter('admission_rejected_total', 'Requests rejected with 503', ['reason'])
+CHANGE_FEED_EVENTS = Counter('change_feed_events_total', 'Change notifications received', ['table'])
+CHANGE_FEED_SUBSCRIBERS = Gauge('change_feed_subscribers', 'Open /v1/events streams', multiprocess_mode='livesum')
+CHANGE_FEED_DROPPED = Counter('change_feed_dropped_total', 'Event streams closed because the subscriber fell behind')
+COMPRESS_LATENCY = Histogram('response_compress_duration_seconds', 'Response compression time', ['coding'])
+COMPRESS_RATIO = Histogram(
+    'response_compress_ratio', 'Compressed to original body size', ['coding'],
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.8, 1.0, float('inf'))
+)
+LOADER_BATCH_SIZE = Histogram(
+    'loader_batch_size', 'Keys per batched database lookup', ['loader'], buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+)
+
+
+@web.middleware
+async def middleware(request, handler):
+    started = time.perf_counter()
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else 'unmatched'
+    status, size = 500, 0
+    try:
+        response = await handler(request)
+        status, size = response.status, body_size(response)
+        return response
+    except web.HTTPException as e:
+        status, size = e.status, len(e.body or b'')
+        raise
+    finally:
+        REQUESTS.labels(request.method, route, status).inc()
+        REQUEST_LATENCY.labels(request.method, route, status).observe(time.perf_counter() - started)
+        RESPONSE_SIZE.labels(request.method, route, status).observe(size)
+
+
+def body_size(response):
+    if isinstance(response, web.Response) and isinstance(response.body, (bytes, bytearray)):
+        return len(response.body)
+    return response.body_length
+
+
+def registry():
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+    collector_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collector_registry)
+    return collector_registry
+
+
+def observe_pool(name, pool):
+    POOL_SIZE.labels(name).set(pool.get_size())
+    POOL_IDLE.labels(name).set(pool.get_idle_size())
+
+
+@contextlib.contextmanager
+def query_timer(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        QUERY_LATENCY.labels(name).observe(elapsed)
+        profiling.record('query:' + name, elapsed)
+
+
+@contextlib.contextmanager
+def encode_timer(content_type):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        ENCODE_LATENCY.labels(content_type).observe(elapsed)
+        profiling.record('encode', elapsed)
@@ -0,0 +1,34 @@
+from yoyo import step
+
+step("CREATE TABLE row_counts(table_name TEXT PRIMARY KEY, total BIGINT NOT NULL)")
+
+step("CREATE FUNCTION row_counts_insert() RETURNS trigger AS $$"
+     " BEGIN"
+     "  UPDATE row_counts SET total = total + (SELECT COUNT(*) FROM inserted) WHERE table_name = TG_TABLE_NAME;"
+     "  RETURN NULL;"
+     " END"
+     " $$ LANGUAGE plpgsql")
+
+step("CREATE FUNCTION row_counts_delete() RETURNS trigger AS $$"
+     " BEGIN"
+     "  UPDATE row_counts SET total = total - (SELECT COUNT(*) FROM deleted) WHERE table_name = TG_TABLE_NAME;"
+     "  RETURN NULL;"
+     " END"
+     " $$ LANGUAGE plpgsql")
+
+step("LOCK TABLE clients, cards IN SHARE ROW EXCLUSIVE MODE")
+
+step("INSERT INTO row_counts(table_name, total)"
+     " SELECT 'clients', COUNT(*) FROM clients UNION ALL SELECT 'cards', COUNT(*) FROM cards")
+
+step("CREATE TRIGGER clients_count_insert AFTER INSERT ON clients"
+     " REFERENCING NEW TABLE AS inserted FOR EACH STATEMENT EXECUTE PROCEDURE row_counts_insert()")
+
+step("CREATE TRIGGER clients_count_delete AFTER DELETE ON clients"
+     " REFERENCING OLD TABLE AS deleted FOR EACH STATEMENT EXECUTE PROCEDURE row_counts_delete()")
+
+step("CREATE TRIGGER cards_count_insert AFTER INSERT ON cards"
+     " REFERENCING NEW TABLE AS inserted FOR EACH STATEMENT EXECUTE PROCEDURE row_counts_insert()")
+
+step("CREATE TRIGGER cards_count_delete AFTER DELETE ON cards"
+     " REFERENCING OLD TABLE AS deleted FOR EACH STATEMENT EXECUTE PROCEDURE row_counts_delete()")
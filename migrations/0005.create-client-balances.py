@@ -0,0 +1,44 @@
+from yoyo import step
+
+step("CREATE TABLE client_balances("
+     " client_id BIGINT NOT NULL,"
+     " currency TEXT NOT NULL,"
+     " balance NUMERIC NOT NULL DEFAULT 0,"
+     " cards INTEGER NOT NULL DEFAULT 0,"
+     " PRIMARY KEY (client_id, currency))")
+
+step("CREATE FUNCTION client_balances_apply() RETURNS trigger AS $$"
+     " BEGIN"
+     "  IF TG_OP IN ('UPDATE', 'DELETE') THEN"
+     "   INSERT INTO client_balances(client_id, currency, balance, cards)"
+     "   SELECT owner_id, currency, -SUM(balance), -COUNT(*) FROM deleted GROUP BY owner_id, currency"
+     "   ON CONFLICT (client_id, currency) DO UPDATE"
+     "   SET balance = client_balances.balance + EXCLUDED.balance, cards = client_balances.cards + EXCLUDED.cards;"
+     "  END IF;"
+     "  IF TG_OP IN ('INSERT', 'UPDATE') THEN"
+     "   INSERT INTO client_balances(client_id, currency, balance, cards)"
+     "   SELECT owner_id, currency, SUM(balance), COUNT(*) FROM inserted GROUP BY owner_id, currency"
+     "   ON CONFLICT (client_id, currency) DO UPDATE"
+     "   SET balance = client_balances.balance + EXCLUDED.balance, cards = client_balances.cards + EXCLUDED.cards;"
+     "  END IF;"
+     "  IF TG_OP IN ('UPDATE', 'DELETE') THEN"
+     "   DELETE FROM client_balances b USING (SELECT DISTINCT owner_id, currency FROM deleted) d"
+     "   WHERE b.client_id = d.owner_id AND b.currency = d.currency AND b.cards = 0;"
+     "  END IF;"
+     "  RETURN NULL;"
+     " END"
+     " $$ LANGUAGE plpgsql")
+
+step("LOCK TABLE cards IN SHARE ROW EXCLUSIVE MODE")
+
+step("INSERT INTO client_balances(client_id, currency, balance, cards)"
+     " SELECT owner_id, currency, SUM(balance), COUNT(*) FROM cards GROUP BY owner_id, currency")
+
+step("CREATE TRIGGER cards_balance_insert AFTER INSERT ON cards"
+     " REFERENCING NEW TABLE AS inserted FOR EACH STATEMENT EXECUTE PROCEDURE client_balances_apply()")
+
+step("CREATE TRIGGER cards_balance_update AFTER UPDATE ON cards"
+     " REFERENCING OLD TABLE AS deleted NEW TABLE AS inserted FOR EACH STATEMENT EXECUTE PROCEDURE client_balances_apply()")
+
+step("CREATE TRIGGER cards_balance_delete AFTER DELETE ON cards"
+     " REFERENCING OLD TABLE AS deleted FOR EACH STATEMENT EXECUTE PROCEDURE client_balances_apply()")
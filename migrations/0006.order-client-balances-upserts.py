@@ -0,0 +1,26 @@
+from yoyo import step
+
+# Строки client_balances обновляются в порядке ключа, чтобы параллельные пакетные вставки не взаимоблокировались.
+step("CREATE OR REPLACE FUNCTION client_balances_apply() RETURNS trigger AS $$"
+     " BEGIN"
+     "  IF TG_OP IN ('UPDATE', 'DELETE') THEN"
+     "   INSERT INTO client_balances(client_id, currency, balance, cards)"
+     "   SELECT owner_id, currency, -SUM(balance), -COUNT(*) FROM deleted GROUP BY owner_id, currency"
+     "   ORDER BY owner_id, currency"
+     "   ON CONFLICT (client_id, currency) DO UPDATE"
+     "   SET balance = client_balances.balance + EXCLUDED.balance, cards = client_balances.cards + EXCLUDED.cards;"
+     "  END IF;"
+     "  IF TG_OP IN ('INSERT', 'UPDATE') THEN"
+     "   INSERT INTO client_balances(client_id, currency, balance, cards)"
+     "   SELECT owner_id, currency, SUM(balance), COUNT(*) FROM inserted GROUP BY owner_id, currency"
+     "   ORDER BY owner_id, currency"
+     "   ON CONFLICT (client_id, currency) DO UPDATE"
+     "   SET balance = client_balances.balance + EXCLUDED.balance, cards = client_balances.cards + EXCLUDED.cards;"
+     "  END IF;"
+     "  IF TG_OP IN ('UPDATE', 'DELETE') THEN"
+     "   DELETE FROM client_balances b USING (SELECT DISTINCT owner_id, currency FROM deleted) d"
+     "   WHERE b.client_id = d.owner_id AND b.currency = d.currency AND b.cards = 0;"
+     "  END IF;"
+     "  RETURN NULL;"
+     " END"
+     " $$ LANGUAGE plpgsql")
@@ -0,0 +1,4 @@
+from yoyo import step
+
+# Версия строки карты для оптимистичной блокировки (ETag/If-Match в PUT /v1/cards/{id}).
+step("ALTER TABLE cards ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
@@ -0,0 +1,17 @@
+from yoyo import step
+
+# CREATE INDEX CONCURRENTLY нельзя выполнить в транзакции, зато он не блокирует запись в cards на время построения.
+__transactional__ = False
+
+# Карты клиента (баланс с картами, список клиентов, пакетная загрузка) выбираются по owner_id в порядке id.
+# Индекс (owner_id, id) отдаёт их уже упорядоченными и заодно ускоряет проверку внешнего ключа при удалении клиента.
+# Прерванный CREATE INDEX CONCURRENTLY оставляет индекс с indisvalid = false, который IF NOT EXISTS пропустил бы,
+# и миграция считалась бы применённой без рабочего индекса. Такой индекс удаляется перед повторным построением.
+step("DO $$ BEGIN"
+     " IF EXISTS (SELECT 1 FROM pg_index WHERE indexrelid = to_regclass('cards_owner_id_idx') AND NOT indisvalid) THEN"
+     "  DROP INDEX cards_owner_id_idx;"
+     " END IF;"
+     " END $$")
+
+step("CREATE INDEX CONCURRENTLY IF NOT EXISTS cards_owner_id_idx ON cards(owner_id, id)",
+     "DROP INDEX CONCURRENTLY IF EXISTS cards_owner_id_idx")
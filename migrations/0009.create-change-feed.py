@@ -0,0 +1,59 @@
+from yoyo import step
+
+# Изменения cards и clients публикуются в канал change_feed. Номер события берётся из последовательности, общей
+# для всех процессов сервиса, по нему подписчик продолжает поток после переподключения (Last-Event-ID).
+step("CREATE SEQUENCE change_feed_seq")
+
+# Одно уведомление на строку замедляет пакетную вставку в несколько раз, поэтому события оператора собираются
+# в JSON-массивы. В NOTIFY помещается меньше 8000 байт: массивы делятся по накопленному размеру, а строка длиннее
+# 3000 байт передаётся без поля item.
+step("CREATE FUNCTION change_feed_notify() RETURNS trigger AS $$"
+     " DECLARE"
+     "  changes JSON[];"
+     " BEGIN"
+     "  IF TG_TABLE_NAME = 'cards' AND TG_OP = 'UPDATE' THEN"
+     "   changes := ARRAY(SELECT json_build_array(i.owner_id, NULLIF(d.owner_id, i.owner_id), row_to_json(i))"
+     "    FROM inserted i JOIN deleted d ON d.id = i.id ORDER BY i.id);"
+     "  ELSIF TG_TABLE_NAME = 'cards' AND TG_OP = 'INSERT' THEN"
+     "   changes := ARRAY(SELECT json_build_array(i.owner_id, NULL, row_to_json(i)) FROM inserted i ORDER BY i.id);"
+     "  ELSIF TG_TABLE_NAME = 'cards' THEN"
+     "   changes := ARRAY(SELECT json_build_array(d.owner_id, NULL, row_to_json(d)) FROM deleted d ORDER BY d.id);"
+     "  ELSIF TG_OP IN ('INSERT', 'UPDATE') THEN"
+     "   changes := ARRAY(SELECT json_build_array(i.id, NULL, row_to_json(i)) FROM inserted i ORDER BY i.id);"
+     "  ELSE"
+     "   changes := ARRAY(SELECT json_build_array(d.id, NULL, row_to_json(d)) FROM deleted d ORDER BY d.id);"
+     "  END IF;"
+     "  PERFORM pg_notify('change_feed', json_agg(event ORDER BY n)::TEXT)"
+     "  FROM ("
+     "   SELECT event, n, SUM(octet_length(event::TEXT) + 1) OVER (ORDER BY n) / 3500 AS part"
+     "   FROM ("
+     "    SELECT json_build_object("
+     "     'seq', nextval('change_feed_seq'), 'table', TG_TABLE_NAME, 'op', lower(TG_OP),"
+     "     'client_id', change->0, 'previous_client_id', change->1,"
+     "     'item', CASE WHEN octet_length((change->2)::TEXT) <= 3000 THEN change->2 END"
+     "    ) AS event, n"
+     "    FROM unnest(changes) WITH ORDINALITY AS c(change, n)"
+     "   ) events"
+     "  ) parts"
+     "  GROUP BY part;"
+     "  RETURN NULL;"
+     " END"
+     " $$ LANGUAGE plpgsql")
+
+step("CREATE TRIGGER cards_change_feed_insert AFTER INSERT ON cards"
+     " REFERENCING NEW TABLE AS inserted FOR EACH STATEMENT EXECUTE PROCEDURE change_feed_notify()")
+
+step("CREATE TRIGGER cards_change_feed_update AFTER UPDATE ON cards"
+     " REFERENCING OLD TABLE AS deleted NEW TABLE AS inserted FOR EACH STATEMENT EXECUTE PROCEDURE change_feed_notify()")
+
+step("CREATE TRIGGER cards_change_feed_delete AFTER DELETE ON cards"
+     " REFERENCING OLD TABLE AS deleted FOR EACH STATEMENT EXECUTE PROCEDURE change_feed_notify()")
+
+step("CREATE TRIGGER clients_change_feed_insert AFTER INSERT ON clients"
+     " REFERENCING NEW TABLE AS inserted FOR EACH STATEMENT EXECUTE PROCEDURE change_feed_notify()")
+
+step("CREATE TRIGGER clients_change_feed_update AFTER UPDATE ON clients"
+     " REFERENCING OLD TABLE AS deleted NEW TABLE AS inserted FOR EACH STATEMENT EXECUTE PROCEDURE change_feed_notify()")
+
+step("CREATE TRIGGER clients_change_feed_delete AFTER DELETE ON clients"
+     " REFERENCING OLD TABLE AS deleted FOR EACH STATEMENT EXECUTE PROCEDURE change_feed_notify()")
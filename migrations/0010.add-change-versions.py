@@ -0,0 +1,59 @@
+from yoyo import step
+
+# Версии данных для условных GET (ETag, If-None-Match). row_counts.version меняется при каждом операторе,
+# изменившем таблицу, client_balances.version — при каждом изменении карт клиента в этой валюте. Обе версии
+# меняются в той же транзакции, что и данные, поэтому ответ 304 не может вернуть устаревшую страницу.
+step("ALTER TABLE row_counts ADD COLUMN version BIGINT NOT NULL DEFAULT 0")
+
+step("ALTER TABLE client_balances ADD COLUMN version BIGINT NOT NULL DEFAULT 1")
+
+step("CREATE OR REPLACE FUNCTION row_counts_insert() RETURNS trigger AS $$"
+     " BEGIN"
+     "  UPDATE row_counts SET total = total + (SELECT COUNT(*) FROM inserted), version = version + 1"
+     "  WHERE table_name = TG_TABLE_NAME;"
+     "  RETURN NULL;"
+     " END"
+     " $$ LANGUAGE plpgsql")
+
+step("CREATE OR REPLACE FUNCTION row_counts_delete() RETURNS trigger AS $$"
+     " BEGIN"
+     "  UPDATE row_counts SET total = total - (SELECT COUNT(*) FROM deleted), version = version + 1"
+     "  WHERE table_name = TG_TABLE_NAME;"
+     "  RETURN NULL;"
+     " END"
+     " $$ LANGUAGE plpgsql")
+
+step("CREATE FUNCTION row_counts_update() RETURNS trigger AS $$"
+     " BEGIN"
+     "  UPDATE row_counts SET version = version + 1 WHERE table_name = TG_TABLE_NAME;"
+     "  RETURN NULL;"
+     " END"
+     " $$ LANGUAGE plpgsql")
+
+step("CREATE TRIGGER clients_count_update AFTER UPDATE ON clients FOR EACH STATEMENT EXECUTE PROCEDURE row_counts_update()")
+
+step("CREATE TRIGGER cards_count_update AFTER UPDATE ON cards FOR EACH STATEMENT EXECUTE PROCEDURE row_counts_update()")
+
+# Строки без карт больше не удаляются: версия клиента — сумма версий его строк и только растёт. Удалённая и заново
+# созданная строка могла бы вернуть сумму, которую клиент уже видел.
+step("CREATE OR REPLACE FUNCTION client_balances_apply() RETURNS trigger AS $$"
+     " BEGIN"
+     "  IF TG_OP IN ('UPDATE', 'DELETE') THEN"
+     "   INSERT INTO client_balances(client_id, currency, balance, cards)"
+     "   SELECT owner_id, currency, -SUM(balance), -COUNT(*) FROM deleted GROUP BY owner_id, currency"
+     "   ORDER BY owner_id, currency"
+     "   ON CONFLICT (client_id, currency) DO UPDATE"
+     "   SET balance = client_balances.balance + EXCLUDED.balance, cards = client_balances.cards + EXCLUDED.cards,"
+     "   version = client_balances.version + 1;"
+     "  END IF;"
+     "  IF TG_OP IN ('INSERT', 'UPDATE') THEN"
+     "   INSERT INTO client_balances(client_id, currency, balance, cards)"
+     "   SELECT owner_id, currency, SUM(balance), COUNT(*) FROM inserted GROUP BY owner_id, currency"
+     "   ORDER BY owner_id, currency"
+     "   ON CONFLICT (client_id, currency) DO UPDATE"
+     "   SET balance = client_balances.balance + EXCLUDED.balance, cards = client_balances.cards + EXCLUDED.cards,"
+     "   version = client_balances.version + 1;"
+     "  END IF;"
+     "  RETURN NULL;"
+     " END"
+     " $$ LANGUAGE plpgsql")
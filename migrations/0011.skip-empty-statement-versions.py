@@ -0,0 +1,46 @@
+from yoyo import step
+
+# Триггеры row_counts срабатывают на каждый оператор, в том числе не изменивший ни одной строки: PUT несуществующей
+# карты, повтор change_card после конфликта версии, пакет карт неизвестных владельцев. Такой оператор менял версию
+# таблицы, а с ней ETag всех страниц, и брал блокировку строки row_counts. Пустой оператор теперь ничего не меняет.
+step("CREATE OR REPLACE FUNCTION row_counts_insert() RETURNS trigger AS $$"
+     " BEGIN"
+     "  IF NOT EXISTS (SELECT FROM inserted) THEN"
+     "   RETURN NULL;"
+     "  END IF;"
+     "  UPDATE row_counts SET total = total + (SELECT COUNT(*) FROM inserted), version = version + 1"
+     "  WHERE table_name = TG_TABLE_NAME;"
+     "  RETURN NULL;"
+     " END"
+     " $$ LANGUAGE plpgsql")
+
+step("CREATE OR REPLACE FUNCTION row_counts_delete() RETURNS trigger AS $$"
+     " BEGIN"
+     "  IF NOT EXISTS (SELECT FROM deleted) THEN"
+     "   RETURN NULL;"
+     "  END IF;"
+     "  UPDATE row_counts SET total = total - (SELECT COUNT(*) FROM deleted), version = version + 1"
+     "  WHERE table_name = TG_TABLE_NAME;"
+     "  RETURN NULL;"
+     " END"
+     " $$ LANGUAGE plpgsql")
+
+step("CREATE OR REPLACE FUNCTION row_counts_update() RETURNS trigger AS $$"
+     " BEGIN"
+     "  IF NOT EXISTS (SELECT FROM inserted) THEN"
+     "   RETURN NULL;"
+     "  END IF;"
+     "  UPDATE row_counts SET version = version + 1 WHERE table_name = TG_TABLE_NAME;"
+     "  RETURN NULL;"
+     " END"
+     " $$ LANGUAGE plpgsql")
+
+step("DROP TRIGGER clients_count_update ON clients")
+
+step("CREATE TRIGGER clients_count_update AFTER UPDATE ON clients"
+     " REFERENCING NEW TABLE AS inserted FOR EACH STATEMENT EXECUTE PROCEDURE row_counts_update()")
+
+step("DROP TRIGGER cards_count_update ON cards")
+
+step("CREATE TRIGGER cards_count_update AFTER UPDATE ON cards"
+     " REFERENCING NEW TABLE AS inserted FOR EACH STATEMENT EXECUTE PROCEDURE row_counts_update()")
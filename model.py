@@ -1,13 +1,16 @@
-import itertools
+import asyncio
+import math
 
 from asyncpg.exceptions import ForeignKeyViolationError
-from database import Database
 from dataclasses import dataclass, replace
-from voluptuous import Schema, Required
+from loader import BatchLoader
+from voluptuous import All, Invalid, MultipleInvalid, Schema
 
 
+# Типы со __slots__: без __dict__ у каждого экземпляра, что заметно на страницах из сотен тысяч строк.
 @dataclass(frozen=True)
 class Client:
+    __slots__ = ('id', 'name', 'cards')
     id: int
     name: str
     cards: list
@@ -15,11 +18,14 @@ class Client:
 
 @dataclass(frozen=True)
 class Balance(Client):
+    __slots__ = ('balance', 'currencies')
     balance: float
+    currencies: dict
 
 
 @dataclass(frozen=True)
 class Card:
+    __slots__ = ('id', 'owner_id', 'payment_system', 'currency', 'balance')
     id: int
     owner_id: int
     payment_system: str
@@ -27,63 +33,290 @@ class Card:
     balance: float
 
 
+@dataclass(frozen=True)
+class BatchResult:
+    __slots__ = ('index', 'status', 'item', 'error')
+    index: int
+    status: str
+    item: object
+    error: str
+
+
+class Columns:
+    """
+    Страница объектов data_type по столбцам: кортеж значений на каждое поле вместо объекта на каждую строку.
+
+    Кодировщики protocol.py обходят столбцы напрямую. Объект строки создаётся только при обращении по индексу
+    или при переборе.
+    """
+    __slots__ = ('data_type', 'columns')
+
+    def __init__(self, data_type, columns):
+        self.data_type = data_type
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __getitem__(self, index):
+        return self.data_type(*[column[index] for column in self.columns])
+
+    def __iter__(self):
+        return (self.data_type(*row) for row in zip(*self.columns))
+
+
+def finite(value):
+    # NaN и бесконечность проходят проверку типа float, но в numeric сумма с NaN навсегда остаётся NaN.
+    if not math.isfinite(value):
+        raise Invalid('expected a finite number')
+    return value
+
+
+class Validator:
+    """
+    Проверка тела запроса по типам полей.
+
+    Схема voluptuous собирается один раз. Корректное тело проверяется без неё: достаточно сравнить ключи и типы
+    значений. Схема выполняется, только если быстрая проверка не прошла, и формирует текст ошибки (MultipleInvalid).
+    Поля float принимают только конечные значения.
+    """
+
+    def __init__(self, fields, required):
+        self.__fields = fields
+        self.__required = required
+        self.__schema = Schema(
+            {key: All(float, finite) if data_type is float else data_type for key, data_type in fields.items()},
+            required=required
+        )
+
+    def __call__(self, data):
+        if not self.__valid(data):
+            self.__schema(data)
+
+    def __valid(self, data):
+        if not isinstance(data, dict) or (self.__required and len(data) != len(self.__fields)):
+            return False
+        for key, value in data.items():
+            data_type = self.__fields.get(key)
+            if data_type is None or not isinstance(value, data_type):
+                return False
+            if data_type is float and not math.isfinite(value):
+                return False
+        return True
+
+
+CARD_FIELDS = {'owner_id': int, 'payment_system': str, 'currency': str, 'balance': float}
+CARD_VALIDATOR = Validator(CARD_FIELDS, required=True)
+CARD_CHANGE_VALIDATOR = Validator(CARD_FIELDS, required=False)
+CLIENT_FIELDS = {'name': str}
+CLIENT_VALIDATOR = Validator(CLIENT_FIELDS, required=True)
+
+
 class ItemNotFoundException(Exception):
     pass
 
 
+class PreconditionFailedException(Exception):
+    pass
+
+
+class OverloadedException(Exception):
+    pass
+
+
+class MalformedRowException(Exception):
+    """Строка пакета, которую не удалось разобрать. Передаётся в add_cards/add_clients вместо данных строки."""
+    pass
+
+
 class ClientModel:
-    def __init__(self, transactor):
-        self.__data_source = Database(transactor)
+    BATCH_CHUNK_SIZE = 1000
+
+    def __init__(self, data_source, cache, batch_window=0.0):
+        self.__data_source = data_source
+        self.__cache = cache
+        # Пакеты делятся по источнику чтения, чтобы версии и данные запроса читались из одной реплики.
+        by_client = data_source.read_source
+        self.__balances = BatchLoader(
+            'client_balances', data_source.client_balances, batch_window, partition=by_client
+        )
+        self.__cards = BatchLoader('cards_by_owner_ids', self.__cards_by_owner_ids, batch_window, partition=by_client)
+        self.__table_versions = BatchLoader(
+            'table_versions', data_source.table_versions, batch_window, partition=lambda _: data_source.read_source()
+        )
+        self.__balance_versions = BatchLoader(
+            'balance_versions', data_source.balance_versions, batch_window, partition=by_client
+        )
+
+    def begin_read(self):
+        self.__data_source.begin_read()
+
+    async def __cards_by_owner_ids(self, ids, source=None):
+        cards = {client_id: [] for client_id in ids}
+        for card in await self.__data_source.all_cards_by_owner_ids(ids, source):
+            cards[card.owner_id].append(card)
+        return [cards[client_id] for client_id in ids]
+
+    @staticmethod
+    def __row_error(validator, data):
+        # Текст ошибки строки пакета или None, если строка корректна.
+        if isinstance(data, MalformedRowException):
+            return str(data)
+        try:
+            validator(data)
+        except MultipleInvalid as e:
+            return str(e)
+        return None
+
+    def changed(self, table, client_ids):
+        """
+        Изменение из потока изменений, в том числе сделанное другим процессом: данные клиентов client_ids
+        читаются из основного сервера, затронутые ответы удаляются из кэша. (None, None) — изменения неизвестны.
+        """
+        self.__data_source.mark_written(client_ids)
+        if table is None:
+            self.__cache.clear()
+            self.__clear_loaders()
+        elif table == 'cards':
+            self.__invalidate('cards', 'clients', *[('balance', client_id) for client_id in client_ids])
+        else:
+            self.__invalidate('clients', *[('balance', client_id) for client_id in client_ids])
+
+    def __invalidate(self, *tags):
+        self.__cache.invalidate(*tags)
+        self.__clear_loaders()
+
+    def __clear_loaders(self):
+        self.__balances.clear()
+        self.__cards.clear()
+        self.__table_versions.clear()
+        self.__balance_versions.clear()
+
+    async def all_cards(self, offset, limit, after=None, total=True):
+        if after is not None:
+            return await self.__data_source.all_cards_after(after, limit, total)
+        return await self.__data_source.all_cards(offset, limit, total)
+
+    async def cards_version(self):
+        return await self.__table_versions.load('cards')
+
+    def stream_cards(self, offset, limit, after=None):
+        return self.__data_source.iter_cards(offset, limit, after)
 
-    async def all_cards(self, offset, limit):
-        return await self.__data_source.all_cards(offset, limit)
+    async def export_cards(self, output, ndjson, owner_ids=None, currencies=None, payment_systems=None):
+        await self.__data_source.export_cards(output, ndjson, owner_ids, currencies, payment_systems)
 
     async def add_card(self, data):
-        Schema({
-            'owner_id': int,
-            'payment_system': str,
-            'currency': str,
-            'balance': float,
-        }, required=True)(data)
+        CARD_VALIDATOR(data)
         try:
-            return await self.__data_source.add_card(
+            card, version = await self.__data_source.add_card(
                 data['owner_id'], data['payment_system'], data['currency'], data['balance']
             )
         except ForeignKeyViolationError:
             raise ItemNotFoundException('Клиент с идентификатором {} не найден'.format(data['owner_id']))
+        self.__invalidate('cards', 'clients', ('balance', card.owner_id))
+        return card, version
 
-    async def all_clients(self, offset, limit):
-        clients, count = await self.__data_source.all_clients(offset, limit)
-        cards = {k: list(v) for (k, v) in itertools.groupby(
-            await self.__data_source.all_cards_by_owner_ids(list(map(lambda x: x.id, clients))), lambda x: x.owner_id
-        )}
-        return list(map(lambda x: replace(x, cards=cards.get(x.id, list())), clients)), count
+    async def add_cards(self, rows):
+        results = []
+        chunk = []
+        async for data in rows:
+            index = len(results)
+            results.append(None)
+            error = self.__row_error(CARD_VALIDATOR, data)
+            if error is not None:
+                results[index] = BatchResult(index=index, status='invalid', item=None, error=error)
+                continue
+            chunk.append((index, data))
+            if len(chunk) >= self.BATCH_CHUNK_SIZE:
+                await self.__add_cards_chunk(chunk, results)
+                chunk = []
+        if chunk:
+            await self.__add_cards_chunk(chunk, results)
+        return results
+
+    async def __add_cards_chunk(self, chunk, results):
+        cards = await self.__data_source.add_cards([
+            (data['owner_id'], data['payment_system'], data['currency'], data['balance']) for (_, data) in chunk
+        ])
+        for (index, data), card in zip(chunk, cards):
+            if card is None:
+                results[index] = BatchResult(
+                    index=index, status='not_found', item=None,
+                    error='Клиент с идентификатором {} не найден'.format(data['owner_id'])
+                )
+            else:
+                results[index] = BatchResult(index=index, status='created', item=card, error=None)
+        self.__invalidate('cards', 'clients', *{('balance', card.owner_id) for card in cards if card is not None})
+
+    async def all_clients(self, offset, limit, after=None, total=True):
+        if after is not None:
+            return await self.__data_source.all_clients_after(after, limit, total)
+        return await self.__data_source.all_clients(offset, limit, total)
+
+    async def clients_version(self):
+        # Страница клиентов содержит их карты, поэтому меняется и при изменении cards.
+        clients, cards = await asyncio.gather(self.__table_versions.load('clients'), self.__table_versions.load('cards'))
+        return '{}.{}'.format(clients, cards)
+
+    def stream_clients(self, offset, limit, after=None):
+        return self.__data_source.iter_clients(offset, limit, after)
+
+    async def export_clients(self, output, ndjson):
+        await self.__data_source.export_clients(output, ndjson)
 
     async def add_client(self, data):
-        Schema({Required('name'): str})(data)
-        return await self.__data_source.add_client(data.get('name'))
+        CLIENT_VALIDATOR(data)
+        client = await self.__data_source.add_client(data.get('name'))
+        self.__invalidate('clients')
+        return client
+
+    async def add_clients(self, rows):
+        results = []
+        chunk = []
+        async for data in rows:
+            index = len(results)
+            results.append(None)
+            error = self.__row_error(CLIENT_VALIDATOR, data)
+            if error is not None:
+                results[index] = BatchResult(index=index, status='invalid', item=None, error=error)
+                continue
+            chunk.append((index, data))
+            if len(chunk) >= self.BATCH_CHUNK_SIZE:
+                await self.__add_clients_chunk(chunk, results)
+                chunk = []
+        if chunk:
+            await self.__add_clients_chunk(chunk, results)
+        return results
+
+    async def __add_clients_chunk(self, chunk, results):
+        clients = await self.__data_source.add_clients([data['name'] for (_, data) in chunk])
+        for (index, _), client in zip(chunk, clients):
+            results[index] = BatchResult(index=index, status='created', item=client, error=None)
+        self.__invalidate('clients')
 
-    async def client_balance(self, client_id):
-        client = await self.__data_source.client_by_id(client_id)
-        if client is None:
+    async def balance_version(self, client_id):
+        # None, если клиента нет.
+        return await self.__balance_versions.load(client_id)
+
+    async def client_balance(self, client_id, with_cards=False):
+        if with_cards:
+            balance, cards = await asyncio.gather(self.__balances.load(client_id), self.__cards.load(client_id))
+        else:
+            balance, cards = await self.__balances.load(client_id), None
+        if balance is None:
             raise ItemNotFoundException('Клиент с идентификатором {} не найден'.format(client_id))
-        cards = await self.__data_source.all_cards_by_client_id(client_id)
-        balance = sum(list(map(lambda x: x.balance, cards)))
-        return Balance(
-            id=client.id,
-            name=client.name,
-            cards=cards,
-            balance=balance
-        )
+        return replace(balance, cards=cards) if with_cards else balance
 
-    async def change_card(self, card_id, data):
-        Schema({
-            'owner_id': int,
-            'payment_system': str,
-            'currency': str,
-            'balance': float,
-        })(data)
-        card = await self.__data_source.change_card(card_id, data)
-        if card is None:
+    async def change_card(self, card_id, data, versions=None):
+        CARD_CHANGE_VALIDATOR(data)
+        try:
+            card, previous_owner_id, version = await self.__data_source.change_card(card_id, data, versions)
+        except ForeignKeyViolationError:
+            raise ItemNotFoundException('Клиент с идентификатором {} не найден'.format(data['owner_id']))
+        if card is None and version is None:
             raise ItemNotFoundException('Карта с идентификатором {} не найдена'.format(card_id))
-        return card
+        if card is None:
+            raise PreconditionFailedException('Карта с идентификатором {} изменена, текущая версия {}'.format(card_id, version))
+        self.__invalidate('cards', 'clients', ('balance', previous_owner_id), ('balance', card.owner_id))
+        return card, version
@@ -0,0 +1,145 @@
+import asyncio
+import collections
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+
+from aiohttp import web
+
+# Разбивка текущего запроса по участкам. Задача каждого запроса aiohttp получает свою копию контекста.
+CURRENT_TRACE = contextvars.ContextVar('request_trace', default=None)
+
+
+class RequestTrace:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = collections.OrderedDict()
+
+    def add(self, name, duration):
+        total, count = self.spans.get(name, (0.0, 0))
+        self.spans[name] = (total + duration, count + 1)
+
+    def summary(self, elapsed):
+        # Участки одного имени (например, порции пакетной вставки) суммируются, в скобках — их число.
+        parts = [
+            '{} {:.3f}s{}'.format(name, total, ' ({})'.format(count) if count > 1 else '')
+            for name, (total, count) in self.spans.items()
+        ]
+        # Остаток — разбор тела, логика модели и сам aiohttp.
+        other = elapsed - sum(total for total, _ in self.spans.values())
+        parts.append('other {:.3f}s'.format(max(other, 0.0)))
+        return ', '.join(parts)
+
+
+def record(name, duration):
+    trace = CURRENT_TRACE.get()
+    if trace is not None:
+        trace.add(name, duration)
+
+
+def untraced():
+    # Общая работа нескольких запросов (пакетные загрузки) не приписывается запросу, который её запустил.
+    CURRENT_TRACE.set(None)
+
+
+class SlowRequestLog:
+    """
+    Журнал медленных запросов.
+
+    Для каждого запроса собирается время по участкам: ожидание в очереди и соединения пула, каждый запрос к базе,
+    пакетные загрузки, кодирование и сжатие ответа. Запрос дольше threshold секунд записывается в журнал одной
+    строкой с этой разбивкой. Участки отмечают те же таймеры, что пишут метрики (модуль metrics). Маршруты из
+    exempt, которые открыты долго по назначению, не учитываются.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, threshold):
+        self.__threshold = threshold
+
+    def middleware(self, exempt=()):
+        @web.middleware
+        async def slow_log(request, handler):
+            resource = request.match_info.route.resource
+            if resource is None or resource.canonical in exempt:
+                return await handler(request)
+            trace = RequestTrace()
+            CURRENT_TRACE.set(trace)
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status
+                return response
+            except web.HTTPException as e:
+                status = e.status
+                raise
+            finally:
+                elapsed = time.perf_counter() - trace.started
+                if elapsed >= self.__threshold:
+                    self.logger.warning(
+                        'Slow request %s %s %s in %.3fs: %s',
+                        request.method, request.path_qs, status, elapsed, trace.summary(elapsed)
+                    )
+
+        return slow_log
+
+
+class ProfilerBusyException(Exception):
+    pass
+
+
+class SamplingProfiler:
+    """
+    Профилировщик цикла событий по выборкам.
+
+    Отдельный поток каждые interval секунд снимает стек потока цикла событий (sys._current_frames) и считает
+    одинаковые стеки. Работа сервиса не останавливается и не замедляется трассировкой вызовов: стоимость — один
+    обход стека на выборку. Результат — свёрнутые стеки (folded stacks) «f1;f2;f3 N», которые принимают
+    flamegraph.pl, speedscope и inferno. Одновременно выполняется только одно профилирование.
+    """
+    ROOT = os.path.dirname(os.path.abspath(__file__)) + os.sep
+
+    def __init__(self):
+        self.__running = False
+        self.__names = {}
+
+    async def profile(self, seconds, interval):
+        if self.__running:
+            raise ProfilerBusyException('Профилирование уже выполняется')
+        self.__running = True
+        stacks = collections.Counter()
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=self.__sample, args=(threading.get_ident(), interval, stop, stacks), name='profiler', daemon=True
+        )
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            stop.set()
+            await asyncio.get_event_loop().run_in_executor(None, sampler.join)
+            self.__running = False
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in stacks.most_common())
+
+    def __sample(self, thread_id, interval, stop, stacks):
+        while not stop.wait(interval):
+            frame = sys._current_frames().get(thread_id)
+            names = []
+            while frame is not None:
+                names.append(self.__name(frame.f_code))
+                frame = frame.f_back
+            if names:
+                stacks[';'.join(reversed(names))] += 1
+
+    def __name(self, code):
+        name = self.__names.get(code)
+        if name is None:
+            filename = code.co_filename
+            if filename.startswith(self.ROOT):
+                filename = filename[len(self.ROOT):]
+            # «;» разделяет кадры в свёрнутом формате.
+            name = '{} ({}:{})'.format(code.co_name, filename, code.co_firstlineno).replace(';', ':')
+            self.__names[code] = name
+        return name
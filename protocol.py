@@ -1,34 +1,223 @@
 import dataclasses
-import dicttoxml
 import json
+import math
+import re
 
-from typing import Iterable
+from model import Columns
+from xml.etree import ElementTree
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8" ?>'
+XML_ESCAPES = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&apos;'})
+XML_NAME = re.compile(r'^(?![Xx][Mm][Ll])[A-Za-z_][\w.-]*$')
+
+
+class Serializer:
+    """
+    Кодировщик одного типа-датакласса.
+
+    Функции преобразования в примитивы (для JSON) и в XML генерируются один раз по списку полей типа,
+    поэтому при кодировании объектов нет ни dataclasses.asdict, ни обхода полей. Для страниц по столбцам (Columns)
+    генерируются такие же функции, которые читают значения из столбцов, а не из атрибутов объектов.
+    """
+    __registry = {}
+    __scalars = {int: 'str({})', float: 'str({})', str: 'xml_text({})', bool: 'xml_text({})'}
+
+    def __init__(self, cls):
+        fields = dataclasses.fields(cls)
+        namespace = {'primitive': primitive, 'xml_text': xml_text, 'xml_value': xml_value}
+
+        def as_primitive(value):
+            return ', '.join(
+                "'{}': {}".format(f.name, value(f) if f.type in self.__scalars else 'primitive({})'.format(value(f)))
+                for f in fields
+            )
+
+        def as_xml(value):
+            return ' + '.join(
+                "'<{0}>' + {1} + '</{0}>'".format(f.name, self.__scalars.get(f.type, 'xml_value({})').format(value(f)))
+                for f in fields
+            )
+
+        columns = ', '.join('c_' + f.name for f in fields)
+        exec(
+            'def to_primitive(o):\n    return {{{}}}\n'.format(as_primitive(lambda f: 'o.' + f.name)) +
+            'def to_xml(o):\n    return {}\n'.format(as_xml(lambda f: 'o.' + f.name)) +
+            'def columns_to_primitive(columns):\n    return [{{{}}} for ({},) in zip(*columns)]\n'.format(
+                as_primitive(lambda f: 'c_' + f.name), columns
+            ) +
+            'def columns_to_xml(columns):\n    return \'\'.join([\'<item>\' + {} + \'</item>\' for ({},) in zip(*columns)])\n'.format(
+                as_xml(lambda f: 'c_' + f.name), columns
+            ),
+            namespace
+        )
+        self.to_primitive = namespace['to_primitive']
+        self.to_xml = namespace['to_xml']
+        self.columns_to_primitive = namespace['columns_to_primitive']
+        self.columns_to_xml = namespace['columns_to_xml']
+
+    @classmethod
+    def of(cls, data_type):
+        serializer = cls.__registry.get(data_type)
+        if serializer is None:
+            serializer = cls.__registry[data_type] = cls(data_type)
+        return serializer
+
+
+def primitive(value):
+    if dataclasses.is_dataclass(value):
+        return Serializer.of(type(value)).to_primitive(value)
+    if isinstance(value, Columns):
+        return Serializer.of(value.data_type).columns_to_primitive(value.columns)
+    if isinstance(value, (list, tuple, frozenset, set)):
+        return [primitive(item) for item in value]
+    if isinstance(value, dict):
+        return {key: primitive(item) for (key, item) in value.items()}
+    return value
+
+
+def xml_text(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value).translate(XML_ESCAPES)
+
+
+def xml_value(value):
+    if dataclasses.is_dataclass(value):
+        return Serializer.of(type(value)).to_xml(value)
+    if isinstance(value, Columns):
+        return Serializer.of(value.data_type).columns_to_xml(value.columns)
+    if isinstance(value, (list, tuple, frozenset, set)):
+        return ''.join(['<item>' + xml_value(item) + '</item>' for item in value])
+    if isinstance(value, dict):
+        return ''.join([
+            '<{0}>{1}</{0}>'.format(key, xml_value(item)) if XML_NAME.match(str(key))
+            else '<key name="{}">{}</key>'.format(xml_text(key), xml_value(item))
+            for (key, item) in value.items()
+        ])
+    return xml_text(value)
+
+
+if orjson is not None:
+    def json_dumps(value):
+        return orjson.dumps(value)
+
+    def json_loads(data):
+        return orjson.loads(data)
+else:
+    def json_dumps(value):
+        return json.dumps(value).encode()
+
+    def json_loads(data):
+        return json.loads(data)
+
+
+def xml_scalar(element, data_type):
+    # Значение, которое не приводится к типу поля, остаётся строкой: ошибку сообщит проверка схемы.
+    if len(element):
+        return None
+    text = element.text or ''
+    if data_type in (int, float):
+        try:
+            value = data_type(text)
+        except ValueError:
+            return text
+        # float() принимает nan, inf и переполняющиеся 1e400, которые не являются числами баланса.
+        return value if data_type is int or math.isfinite(value) else text
+    return text
 
 
 class XMLEncoder:
     content_type = "application/xml"
 
-    def __to_dict(self, o):
-        if isinstance(o, Iterable):
-            return list(map(lambda x: self.__to_dict(x), o))
-        if dataclasses.is_dataclass(o):
-            return dataclasses.asdict(o)
-        return dict(o)
-
     def encode(self, data):
-        return dicttoxml.dicttoxml(obj=self.__to_dict(data), attr_type=False)
+        return (XML_DECLARATION + '<root>' + xml_value(data) + '</root>').encode()
+
+    async def encode_stream(self, items):
+        yield (XML_DECLARATION + '<root>').encode()
+        async for item in items:
+            yield ('<item>' + xml_value(item) + '</item>').encode()
+        yield b'</root>'
 
 
 class JsonEncoder:
     content_type = "application/json"
 
-    class EnhancedJsonEncoder(json.JSONEncoder):
-        def default(self, o):
-            if dataclasses.is_dataclass(o):
-                return dataclasses.asdict(o)
-            if isinstance(o, frozenset):
-                return list(o)
-            return super().default(o)
+    def encode(self, data):
+        return json_dumps(primitive(data))
+
+    async def encode_stream(self, items):
+        separator = b'['
+        async for item in items:
+            yield separator + json_dumps(primitive(item))
+            separator = b','
+        yield b'[]' if separator == b'[' else b']'
+
+
+class NdJsonEncoder:
+    content_type = "application/x-ndjson"
 
     def encode(self, data):
-        return json.dumps(data, cls=self.EnhancedJsonEncoder)
\ No newline at end of file
+        if isinstance(data, Columns):
+            return b''.join(json_dumps(item) + b'\n' for item in primitive(data))
+        if isinstance(data, list):
+            return b''.join(json_dumps(primitive(item)) + b'\n' for item in data)
+        return json_dumps(primitive(data)) + b'\n'
+
+    async def encode_stream(self, items):
+        async for item in items:
+            yield json_dumps(primitive(item)) + b'\n'
+
+
+class XMLDecoder:
+    """
+    Потоковый разбор XML-тела запроса в словари, в формате ответов XMLEncoder.
+
+    Один объект — корневой элемент с полями: <root><name>...</name></root>. Пакет — корневой элемент со списком
+    <item>, как в ответах со списками. Документ разбирается XMLPullParser по мере получения частей тела. Значения
+    полей приводятся к типам из fields; разобранный <item> сразу удаляется из дерева, поэтому дерево документа
+    не растёт с размером пакета.
+    """
+    content_type = "application/xml"
+
+    async def decode(self, chunks, fields):
+        root = None
+        async for event, element in self.__events(chunks):
+            if root is None:
+                root = element
+        return self.__record(root, fields)
+
+    async def decode_stream(self, chunks, fields):
+        depth = 0
+        root = None
+        async for event, element in self.__events(chunks):
+            if event == 'start':
+                depth += 1
+                if root is None:
+                    root = element
+                continue
+            depth -= 1
+            if depth == 1:
+                yield self.__record(element, fields)
+                root.remove(element)
+
+    @staticmethod
+    async def __events(chunks):
+        parser = ElementTree.XMLPullParser(('start', 'end'))
+        async for chunk in chunks:
+            parser.feed(chunk)
+            for event in parser.read_events():
+                yield event
+        parser.close()
+        for event in parser.read_events():
+            yield event
+
+    @staticmethod
+    def __record(element, fields):
+        return {child.tag: xml_scalar(child, fields.get(child.tag, str)) for child in element}